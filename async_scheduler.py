@@ -0,0 +1,128 @@
+import asyncio
+import time
+import numpy as np
+
+
+CONCURRENCY = 30  # Requests in flight
+REPORT_EVERY = 100  # Print the throughput every N finished requests
+
+_done = object()
+
+
+class DepthStats:
+    '''
+    Mean and maximum of a depth that changes over time, like the number of requests
+    in flight. The mean is weighted by how long each depth lasted.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_change = self.start
+        self.depth = 0
+        self.max = 0
+        self.depth_time = 0.0
+
+    def set(self, depth):
+        now = time.perf_counter()
+        self.depth_time += self.depth * (now - self.last_change)
+        self.last_change = now
+        self.depth = depth
+        self.max = max(self.max, depth)
+
+    def elapsed(self):
+        return max(self.last_change - self.start, 1e-9)
+
+    def mean(self):
+        self.set(self.depth)
+        return self.depth_time / self.elapsed()
+
+
+class SchedulerStats:
+    '''
+    Throughput of a sliding window run and how many calls were in progress.
+    With a rate controller most calls in progress may be waiting for a slot, the
+    requests really in flight are in its report.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.in_progress = DepthStats()
+        self.completed = 0
+        self.failed = 0
+
+    def set_depth(self, depth):
+        self.in_progress.set(depth)
+
+    def report(self):
+        in_progress = self.in_progress.mean()
+        elapsed = self.in_progress.elapsed()
+        print(f'{self.name}: {self.completed} requests in {elapsed:.1f}s, '
+              f'{self.completed / elapsed:.2f} req/s, in progress {in_progress:.1f} '
+              f'on average (max {self.in_progress.max})'
+              + (f', {self.failed} failed' if self.failed else ''))
+
+
+class LatencyStats:
+    '''
+    Latencies of the requests of a backend, reported as percentiles.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+
+    def add(self, seconds):
+        self.latencies.append(seconds)
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    def report(self):
+        if not self.latencies:
+            return
+        p50, p90, p95, p99 = np.percentile(self.latencies, [50, 90, 95, 99])
+        print(f'{self.name} latency over {len(self.latencies)} requests: p50 {p50:.2f}s, '
+              f'p90 {p90:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s, max {max(self.latencies):.2f}s')
+
+
+async def run_sliding_window(items, worker, concurrency=CONCURRENCY, name='scheduler'):
+    '''
+    Awaits worker(item) for every item with `concurrency` calls in flight.
+    Unlike gathering fixed batches, a slot is refilled as soon as its call finishes,
+    so one slow request holds up only its own slot.
+    Exceptions of a call are printed and counted, the other calls go on.
+    Returns the SchedulerStats of the run.
+    '''
+    stats = SchedulerStats(name)
+    items = iter(items)
+    in_flight = {}
+
+    def fill():
+        while len(in_flight) < concurrency:
+            item = next(items, _done)
+            if item is _done:
+                break
+            in_flight[asyncio.ensure_future(worker(item))] = item
+        stats.set_depth(len(in_flight))
+
+    try:
+        fill()
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = in_flight.pop(task)
+                stats.completed += 1
+                if task.exception() is not None:
+                    stats.failed += 1
+                    error = task.exception()
+                    print(f'{name}: {item} failed with {type(error).__name__}: {error}')
+                if stats.completed % REPORT_EVERY == 0:
+                    stats.report()
+            fill()
+    finally:
+        # Cancelled runs don't leave requests behind
+        for task in in_flight:
+            task.cancel()
+
+    stats.report()
+    return stats
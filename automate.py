@@ -1,123 +1,428 @@
+import argparse
 import asyncio
 import csv
+import functools
+import importlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 from scipy.io.wavfile import read as read_wav
 import torchaudio
 import os
+import queue
+import threading
+import time
 import torch
-from pydub import AudioSegment
-
-
-def convert_to_mono_and_export(path):
-    """
-    Convert stereo audio files to mono and export them as WAV files with 16-bit samples.
-
-    Args:
-    - path (str): Path to the directory containing the audio files.
-    """
-    # Check if path is a directory
-    if os.path.isdir(path):
-        # Iterate over each file in the directory
-        for filename in os.listdir(path):
-            if filename.endswith(".wav"):
-                file_path = os.path.join(path, filename)
-                sound = AudioSegment.from_wav(file_path)
-
-                # Check if the audio is stereo
-                if sound.channels > 1:
-                    # Convert stereo to mono
-                    sound = sound.set_channels(1)
-
-                # Convert to 16-bit samples
-                sound = sound.set_sample_width(2)  # 2 bytes = 16 bits
-
-                # Export the audio as WAV
-                sound.export(file_path, format="wav")
-                # print(f"Converted '{filename}' to mono with 16-bit samples and exported as WAV.")
-    else:
-        # Assuming it's a CSV file, process accordingly
-        with open(path, "r") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                file_path = row["wav_filename"]
-                if file_path.endswith(".wav"):
-                    sound = AudioSegment.from_wav(file_path)
-
-                    # Check if the audio is stereo
-                    if sound.channels > 1:
-                        # Convert stereo to mono
-                        sound = sound.set_channels(1)
+from mono_audio import convert_to_mono_and_export
+from wav_io import read_wav_mmap
+from feature_cache import FeatureCache
+from batching import MAX_BATCH_BYTES
 
-                    # Convert to 16-bit samples
-                    sound = sound.set_sample_width(2)  # 2 bytes = 16 bits
 
-                    # Export the audio as WAV
-                    sound.export(file_path, format="wav")
-                    # print(f"Converted '{file_path}' to mono with 16-bit samples and exported as WAV.")
-                else:
-                    print(f"'{file_path}' is not a WAV file, skipping.")
+PREFETCH_SIZE = 40  # Number of decoded clips kept ready ahead of the model
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Processes decoding and resampling
+TARGET_SAMPLE_RATE = 16000
+REPORT_EVERY = 500  # Print the decode throughput every N files
 
 
-def process_audio_files(folder_path):
+def list_audio_files(folder_path):
     '''
-    This function processes audio files for Seamless and Whisper
+    Returns the .wav paths of a directory or of a list of file paths,
+    in the order they are processed.
     '''
-    processed_files = []
-    filenames = []
-    # Get a list of all WAV files in the directory
     if isinstance(folder_path, list):
-        wav_files = folder_path
+        # Check if it's a valid file path
+        return [path for path in folder_path
+                if os.path.isfile(path) and path.endswith(".wav")]
+
+    return [os.path.join(folder_path, file) for file in os.listdir(folder_path)
+            if file.endswith(".wav")]
+
+
+def _init_decode_worker():
+    # Each worker decodes one file at a time, more torch threads only compete
+    torch.set_num_threads(1)
+
+
+def decode_audio_file(audio_file_path):
+    '''
+    THIS IS A HELPER FUNCTION FOR decode_audio_files
+    runs process_audio_file in a worker process, numpy arrays are cheaper to send back.
+    '''
+    return process_audio_file(audio_file_path).numpy()
+
 
-        for path in wav_files:
-            # Check if it's a valid file path
-            if os.path.isfile(path) and path.endswith(".wav"):
-                processed_audio = process_audio_file(path)
-                processed_files.append(processed_audio)
-                filenames.append(os.path.basename(path))
+def open_audio_file(audio_file_path):
+    '''
+    THIS IS A HELPER FUNCTION FOR decode_audio_files
+    memory-maps a 16Khz mono 16-bit .wav file without decoding it.
+    Returns None for files that still need to be decoded or resampled.
+    '''
+    try:
+        samples, sampling_rate = read_wav_mmap(audio_file_path)
+    except ValueError:
+        return None
+    if sampling_rate != TARGET_SAMPLE_RATE:
+        return None
+    return samples
 
-    else:
-        wav_files = [file for file in os.listdir(
-            folder_path) if file.endswith(".wav")]
 
-        for file in wav_files:
-            audio_file_path = os.path.join(folder_path, file)
-            processed_audio = process_audio_file(audio_file_path)
-            processed_files.append(processed_audio)
-            filenames.append(file)
+def decode_audio_files(wav_files, workers=DECODE_WORKERS, window=PREFETCH_SIZE, mmap=False):
+    '''
+    Decodes and resamples the files on a pool of worker processes.
+    Yields (path, samples) pairs in input order with at most `window` files in flight.
+    With mmap=True files that are already 16Khz mono 16-bit are memory-mapped
+    instead, their samples are int16 arrays that are only read when a batch is built.
+    '''
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_decode_worker)
+
+    def start(path):
+        samples = open_audio_file(path) if mmap else None
+        if samples is not None:
+            return samples
+        if executor is None:
+            return process_audio_file(path)
+        return executor.submit(decode_audio_file, path)
+
+    paths = iter(wav_files)
+    try:
+        pending = deque((path, start(path)) for path in islice(paths, window))
+        while pending:
+            path, samples = pending.popleft()
+            if isinstance(samples, Future):
+                samples = torch.from_numpy(samples.result())
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, start(next_path)))
+            yield path, samples
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def report_decode_throughput(num_files, elapsed, blocked):
+    '''
+    Prints the decode throughput in files per second. The busy rate leaves out
+    the time spent waiting for the model to take the next clip, when it is much
+    higher than the overall rate decoding is not what limits the run.
+    '''
+    busy = max(elapsed - blocked, 1e-9)
+    print(f'Decoded {num_files} files in {elapsed:.1f}s: '
+          f'{num_files / max(elapsed, 1e-9):.1f} files/s overall, '
+          f'{num_files / busy:.1f} files/s while decoding')
+
+
+def iter_audio_files(folder_path, prefetch=PREFETCH_SIZE, workers=DECODE_WORKERS, mmap=True):
+    '''
+    Lazily loads the audio files for Seamless and Whisper.
+    Yields (filename, samples) pairs while a background thread decodes
+    at most `prefetch` clips ahead of the consumer, so memory stays bounded
+    whatever the corpus size. With mmap=True 16Khz clips are int16 memory maps,
+    see wav_io.BatchBuffer to turn a batch of them into float samples.
+    '''
+    wav_files = list_audio_files(folder_path)
+    clips = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+    blocked = 0.0
+
+    def put(item):
+        nonlocal blocked
+        start = time.perf_counter()
+        try:
+            # Give up when the consumer stopped reading
+            while not stop.is_set():
+                try:
+                    clips.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            blocked += time.perf_counter() - start
+
+    def producer():
+        start = time.perf_counter()
+        num_files = 0
+        try:
+            for path, samples in decode_audio_files(wav_files, workers, prefetch, mmap):
+                if not put((os.path.basename(path), samples)):
+                    return
+                num_files += 1
+                if num_files % REPORT_EVERY == 0:
+                    report_decode_throughput(
+                        num_files, time.perf_counter() - start, blocked)
+        except Exception as e:
+            put(e)
+            return
+        report_decode_throughput(
+            num_files, time.perf_counter() - start, blocked)
+        put(done)
+
+    worker = threading.Thread(target=producer, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = clips.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def process_audio_files(folder_path, stream=False):
+    '''
+    This function processes audio files for Seamless and Whisper.
+    With stream=True it returns a lazy iterator of (filename, samples) pairs
+    instead of loading every file up front.
+    '''
+    if stream:
+        return iter_audio_files(folder_path)
+
+    processed_files = []
+    filenames = []
+    # Get a list of all WAV files in the directory
+    for path, processed_audio in decode_audio_files(list_audio_files(folder_path)):
+        processed_files.append(processed_audio)
+        filenames.append(os.path.basename(path))
 
     return processed_files, filenames
 
 
-def load_audio(audio_file_path):
+def load_audio(audio_file_path, mmap=False):
     '''
     THIS IS A HELPER FUNCTION FOR process_audio_file
-    loads a single .wav file in.
+    loads a single .wav file in, with mmap=True the samples are read from disk
+    while they are converted instead of first being copied into memory.
     '''
-    sampling_rate, data = read_wav(audio_file_path)
+    sampling_rate, data = read_wav(audio_file_path, mmap=mmap)
     return data, sampling_rate
 
 
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq, new_freq=TARGET_SAMPLE_RATE):
+    '''
+    Returns a Resample transform for this pair of rates.
+    The sinc kernel is built once per process and reused for every file
+    with the same source rate.
+    '''
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
 def process_audio_file(audio_file_path):
     '''
     THIS IS A HELPER FUNCTION FOR process_audio_files
     converts a .wav file to a torch tensor and downsample to 16Khz
     '''
     # Load audio data
-    data, sampling_rate = load_audio(audio_file_path)
+    data, sampling_rate = load_audio(audio_file_path, mmap=True)
 
     # Convert audio from numpy array to a torch tensor
     # Convert to floating point type
     audio_tensor = torch.tensor(data, dtype=torch.float32)
 
-    if sampling_rate == 16000:
+    if sampling_rate == TARGET_SAMPLE_RATE:
         return audio_tensor
-    elif sampling_rate != 16000:
-        # Downsample the audio
-        audio_tensor_resampled = torchaudio.functional.resample(
-            audio_tensor, orig_freq=sampling_rate, new_freq=16000)
+    elif sampling_rate != TARGET_SAMPLE_RATE:
+        # Downsample the audio with the cached kernel for this rate
+        audio_tensor_resampled = get_resampler(sampling_rate)(audio_tensor)
         return audio_tensor_resampled
 
 
+LOCAL_BACKENDS = ('seamless', 'whisper')
+# Cloud backends only need the file paths, they upload the files themselves
+CLOUD_BACKENDS = {
+    'deepgram': 'deepgram_model',
+    'google': 'google_model',
+    'google_tel': 'google_model_tel',
+    'chirp': 'chirp',
+}
+
+
+def read_audio_list(audio_dir):
+    '''
+    Returns the wav_filename column for a CSV file, directories are returned as is.
+    '''
+    if audio_dir.endswith(".csv"):
+        with open(audio_dir, "r") as file:
+            reader = csv.DictReader(file)
+            return [row["wav_filename"] for row in reader]
+    return audio_dir
+
+
+def fan_out(stream, num_consumers, maxsize=PREFETCH_SIZE):
+    '''
+    Shares one stream of (filename, samples) pairs between several consumers.
+    Every clip is loaded once and handed to each consumer through a bounded queue,
+    so the slowest consumer sets the pace and memory stays bounded.
+    Returns one iterator per consumer.
+    '''
+    queues = [queue.Queue(maxsize=maxsize) for _ in range(num_consumers)]
+    stopped = [threading.Event() for _ in range(num_consumers)]
+    done = object()
+
+    def put(i, item):
+        # Consumers that stopped reading are skipped
+        while not stopped[i].is_set():
+            try:
+                queues[i].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def producer():
+        try:
+            for item in stream:
+                if all(event.is_set() for event in stopped):
+                    return
+                for i in range(num_consumers):
+                    put(i, item)
+        except Exception as e:
+            for i in range(num_consumers):
+                put(i, e)
+            return
+        for i in range(num_consumers):
+            put(i, done)
+
+    def consume(i):
+        try:
+            while True:
+                item = queues[i].get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped[i].set()
+
+    threading.Thread(target=producer, daemon=True).start()
+    return [consume(i) for i in range(num_consumers)]
+
+
+def load_local_backend(backend, batch_seconds=None, max_batch_bytes=MAX_BATCH_BYTES,
+                       vad=False, whisper_options=None, feature_cache=False):
+    '''
+    Loads a local model and returns a function that transcribes a stream of clips.
+    batch_seconds None keeps the default budget of the model.
+    With feature_cache the input features are cached on disk, see feature_cache.py.
+    '''
+    cache = FeatureCache() if feature_cache else None
+    if backend == 'seamless':
+        from seamless_model import load_seamless_model, process_audio_transcriptions
+        model, processor = load_seamless_model()
+        return lambda stream: process_audio_transcriptions(
+            stream, None, model, processor, cache, batch_seconds, max_batch_bytes, vad)
+
+    from whisper_model import process_audio_transcriptions_with_pipe, load_whisper_model
+    pipe = load_whisper_model(**(whisper_options or {}))
+    return lambda stream: process_audio_transcriptions_with_pipe(
+        stream, None, pipe, cache, batch_seconds, max_batch_bytes, vad)
+
+
+async def timed(backend, job):
+    start = time.perf_counter()
+    await job
+    elapsed = time.perf_counter() - start
+    print(f'{backend} finished in {elapsed:.1f}s')
+    return elapsed
+
+
+async def run_backends(backends, audio_dir, batch_seconds=None,
+                       max_batch_bytes=MAX_BATCH_BYTES, vad=False, whisper_options=None,
+                       feature_cache=False):
+    '''
+    Transcribes the audio with several backends in one run.
+    The audio is normalized once and every clip is decoded once for all local models,
+    which run on worker threads. The cloud backends run concurrently on the event loop,
+    so the run takes about as long as the slowest backend.
+    '''
+    # Convert stereo audio files to mono if necessary
+    convert_to_mono_and_export(audio_dir)
+    audio_files = read_audio_list(audio_dir)
+
+    local = [backend for backend in backends if backend in LOCAL_BACKENDS]
+    cloud = [backend for backend in backends if backend in CLOUD_BACKENDS]
+
+    # Load the models up front so the decoded audio doesn't wait on them
+    transcribers = [load_local_backend(backend, batch_seconds, max_batch_bytes, vad,
+                                       whisper_options, feature_cache)
+                    for backend in local]
+
+    jobs = []
+    if local:
+        streams = fan_out(process_audio_files(audio_files, stream=True), len(local))
+        for backend, transcribe, stream in zip(local, transcribers, streams):
+            jobs.append(timed(backend, asyncio.to_thread(transcribe, stream)))
+    for backend in cloud:
+        module = importlib.import_module(CLOUD_BACKENDS[backend])
+        jobs.append(timed(backend, module.process_audio(audio_files)))
+
+    start = time.perf_counter()
+    elapsed = await asyncio.gather(*jobs)
+    print(f'All backends finished in {time.perf_counter() - start:.1f}s '
+          f'(sum of the backends: {sum(elapsed):.1f}s)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Transcribe audio files, without arguments the model is asked interactively.")
+    parser.add_argument("--backends", help="comma separated list of backends to run in one go: "
+                        + ", ".join(LOCAL_BACKENDS + tuple(CLOUD_BACKENDS)))
+    parser.add_argument("--audio", help="path to the audio directory or CSV file")
+    parser.add_argument("--batch-seconds", type=float, default=None,
+                        help="seconds of padded audio per batch for the local models "
+                             "(default: 300 for Seamless, 24 windows of 30 seconds for Whisper)")
+    parser.add_argument("--max-batch-gb", type=float, default=MAX_BATCH_BYTES / 1024 ** 3,
+                        help="estimated memory a batch of a local model may use")
+    parser.add_argument("--vad", action="store_true",
+                        help="trim silences and cut the audio at pauses before the local models")
+    parser.add_argument("--feature-cache", action="store_true",
+                        help="cache the input features of the local models on disk, "
+                             "for repeated runs over the same audio")
+    parser.add_argument("--quantize", action="store_true",
+                        help="run Whisper with int8 linear layers on CPU")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the Whisper encoder on CPU")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch intra-op threads for Whisper")
+    parser.add_argument("--interop-threads", type=int, default=None,
+                        help="torch inter-op threads for Whisper")
+    parser.add_argument("--assistant", nargs="?", const="distil-whisper/distil-large-v3", default=None,
+                        help="draft model for assisted decoding with Whisper (default distil-large-v3), "
+                             "it needs the same 128 mel bins as large-v3")
+    args = parser.parse_args()
+    args.whisper_options = dict(
+        quantize=args.quantize, compile=args.compile,
+        num_threads=args.threads, num_interop_threads=args.interop_threads,
+        assistant_model_id=args.assistant)
+
+    if args.backends:
+        args.backends = [backend.strip() for backend in args.backends.split(",")]
+        unknown = [backend for backend in args.backends
+                   if backend not in LOCAL_BACKENDS and backend not in CLOUD_BACKENDS]
+        if unknown:
+            parser.error(f"unknown backends: {', '.join(unknown)}")
+        if not args.audio:
+            parser.error("--audio is required with --backends")
+    return args
+
+
 async def main():
+    args = parse_args()
+    max_batch_bytes = args.max_batch_gb * 1024 ** 3
+    if args.backends:
+        await run_backends(args.backends, args.audio, args.batch_seconds, max_batch_bytes,
+                           args.vad, args.whisper_options, args.feature_cache)
+        return
+
     print("Available models:")
     print("1. Seamless Model")
     print("2. Whisper")
@@ -133,7 +438,7 @@ async def main():
         model, processor = load_seamless_model()
     elif choice == "2":
         from whisper_model import process_audio_transcriptions_with_pipe, load_whisper_model
-        model = load_whisper_model()
+        model = load_whisper_model(**args.whisper_options)
     elif choice == "3":
         from deepgram_model import process_audio
     elif choice == "4":
@@ -146,20 +451,20 @@ async def main():
     audio_dir = input("Enter the path to the audio directory: ")
     # Convert stereo audio files to mono if necessary
     convert_to_mono_and_export(audio_dir)
-    if audio_dir.endswith(".csv"):
-        with open(audio_dir, "r") as file:
-            reader = csv.DictReader(file)
-            audio_dir = [row["wav_filename"] for row in reader]
+    audio_dir = read_audio_list(audio_dir)
 
     # Process audio files and get translations
+    feature_cache = FeatureCache() if args.feature_cache else None
     if choice == "1":
-        processed_files, filenames = process_audio_files(audio_dir)
+        audio_stream = process_audio_files(audio_dir, stream=True)
         process_audio_transcriptions(
-            processed_files, filenames, model, processor)
+            audio_stream, None, model, processor, feature_cache, args.batch_seconds,
+            max_batch_bytes, args.vad)
     elif choice == "2":
-        processed_files, filenames = process_audio_files(audio_dir)
+        audio_stream = process_audio_files(audio_dir, stream=True)
         process_audio_transcriptions_with_pipe(
-            processed_files, filenames, model)
+            audio_stream, None, model, feature_cache, args.batch_seconds,
+            max_batch_bytes, args.vad)
     elif choice == "3":
         await process_audio(audio_dir)
     elif choice == "4":
@@ -0,0 +1,135 @@
+from itertools import islice
+
+
+def batched(iterable, batch_size):
+    '''
+    Splits an iterable into lists of at most batch_size items.
+    Works on lazy iterators, so only one batch is held in memory at a time.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def as_clip_stream(data, wav_files=None):
+    '''
+    Returns an iterator of (filename, samples) pairs.
+    data can be a list of samples with the matching wav_files,
+    or already a stream of (filename, samples) pairs when wav_files is None.
+    '''
+    if wav_files is None:
+        return iter(data)
+    return zip(wav_files, data)
+
+
+# Clips sorted by length together, written back in input order. Every memory-mapped
+# clip keeps a file open and the pipeline holds about two windows at once, so this
+# stays well under the usual limit of 1024 open files
+BUCKET_WINDOW = 200
+BATCH_SECONDS = 300  # Seconds of padded audio per batch
+MAX_BATCH_CLIPS = 256
+MAX_BATCH_BYTES = 4 * 1024 ** 3  # Estimated memory a batch of a local model may use
+SAMPLE_RATE = 16000
+
+
+def budget_batches(order, lengths, max_seconds=BATCH_SECONDS, max_clips=MAX_BATCH_CLIPS,
+                   max_bytes=None, clip_bytes=None, clip_length=None):
+    '''
+    Cuts indices sorted by length into batches that fit a budget instead of a fixed size.
+    Every clip in a batch is padded to the longest one, so a batch costs
+    longest clip x number of clips, which has to stay under max_seconds of audio.
+    clip_length(length) gives the samples a model really processes for a clip,
+    when it pads further than the longest clip (Whisper pads to 30 second windows).
+    With max_bytes, clip_bytes(length) estimates the memory one padded clip needs
+    and the batch has to stay under max_bytes as well.
+    A clip that is over the budget on its own gets a batch of its own.
+    '''
+    batch = []
+    longest = 0
+    for i in order:
+        padded = max(longest, lengths[i])
+        cost = padded if clip_length is None else clip_length(padded)
+        size = len(batch) + 1
+        over_budget = (cost * size > max_seconds * SAMPLE_RATE
+                       or size > max_clips
+                       or (max_bytes is not None and size * clip_bytes(padded) > max_bytes))
+        if batch and over_budget:
+            yield batch
+            batch = []
+            padded = lengths[i]
+        batch.append(i)
+        longest = padded
+    if batch:
+        yield batch
+
+
+def bucket_batches(clips, max_seconds=BATCH_SECONDS, max_clips=MAX_BATCH_CLIPS,
+                   max_bytes=None, clip_bytes=None, clip_length=None, window_size=BUCKET_WINDOW,
+                   split=None):
+    '''
+    Groups clips of similar length in the same batch, so one long clip doesn't
+    make the short ones around it wait for padding and generation.
+    Reads window_size (filename, samples) pairs at a time, sorts them by length
+    and cuts them into batches with budget_batches, so short clips batch by the
+    hundreds and long ones by only a few.
+    split optionally cuts a clip into segments, for example vad.split_on_silence.
+    Yields (window, segments, batches): window holds the pairs in input order,
+    segments holds (index in window, samples) pairs and batches holds lists of
+    indices into segments, so results can be written back in the original order.
+    '''
+    for window in batched(clips, window_size):
+        if split is None:
+            segments = [(i, samples) for i, (_, samples) in enumerate(window)]
+        else:
+            segments = [(i, segment) for i, (_, samples) in enumerate(window)
+                        for segment in split(samples)]
+        lengths = [len(samples) for _, samples in segments]
+        order = sorted(range(len(segments)), key=lambda i: lengths[i])
+        yield window, segments, list(budget_batches(order, lengths, max_seconds, max_clips,
+                                                    max_bytes, clip_bytes, clip_length))
+
+
+def join_segments(window, segments, texts, clips=None):
+    '''
+    Joins the transcripts of the segments of each clip, in the original order.
+    Returns (filename, transcript) pairs, clips with a failed segment are left out.
+    clips limits the result to these indices into window.
+    '''
+    parts = [[] for _ in window]
+    failed = set()
+    for (i, _), text in zip(segments, texts):
+        if text is None:
+            failed.add(i)
+        else:
+            parts[i].append(text.strip())
+    indices = range(len(window)) if clips is None else sorted(clips)
+    return [(window[i][0], ' '.join(part for part in parts[i] if part))
+            for i in indices if i not in failed]
+
+
+class BatchStats:
+    '''
+    Keeps track of how much of the batches is padding and how long each clip takes.
+    '''
+
+    def __init__(self):
+        self.clips = 0
+        self.samples = 0
+        self.padded_samples = 0
+        self.seconds = 0.0
+
+    def add(self, lengths, seconds):
+        self.clips += len(lengths)
+        self.samples += sum(lengths)
+        self.padded_samples += max(lengths) * len(lengths)
+        self.seconds += seconds
+
+    def report(self):
+        if not self.clips:
+            return
+        padding = 1 - self.samples / max(self.padded_samples, 1)
+        print(f'{self.clips} clips, {100 * padding:.1f}% of the batched samples were padding, '
+              f'{1000 * self.seconds / self.clips:.0f} ms per clip')
@@ -0,0 +1,131 @@
+import argparse
+import csv
+import os
+import re
+import time
+import jiwer
+from automate import process_audio_files
+from whisper_model import ASSISTANT_MODEL_ID, generate_kwargs, load_whisper_model
+
+
+SUBSET_CSV = './cgn_cd_vlnl.csv'
+SUBSET_SIZE = 50  # The first rows of the CSV, so every run uses the same clips
+BATCH_SIZE = 8
+
+# Mode name: (load_whisper_model options, batch size)
+MODES = {
+    'float32': ({}, BATCH_SIZE),
+    'int8': ({'quantize': True}, BATCH_SIZE),
+    'int8-compiled': ({'quantize': True, 'compile': True}, BATCH_SIZE),
+    # Assisted decoding handles one clip at a time, compare it with greedy at batch size 1
+    'greedy-bs1': ({}, 1),
+    'assisted': ({'assistant_model_id': ASSISTANT_MODEL_ID}, 1),
+}
+
+
+def load_subset(csv_path, size):
+    '''
+    Returns the paths and reference transcripts of the first `size` rows of a CGN CSV.
+    Every file has to exist, a skipped clip would pair the other transcripts with the
+    wrong references.
+    '''
+    paths = []
+    references = []
+    with open(csv_path, "r") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            if len(paths) == size:
+                break
+            paths.append(row["wav_filename"])
+            references.append(row["transcript"])
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f'{len(missing)} of the {len(paths)} clips of {csv_path} '
+                                f'are missing, for example {missing[0]}')
+    return paths, references
+
+
+def normalize(text):
+    # The CGN references are lower case without punctuation
+    return " ".join(re.sub(r"[^\w' ]", " ", text.lower()).split())
+
+
+def transcribe(pipe, audio, batch_size=BATCH_SIZE):
+    result = pipe(audio, batch_size=batch_size, generate_kwargs=generate_kwargs())
+    return [item['text'] for item in result]
+
+
+def run_mode(name, options, batch_size, audio, references, audio_seconds,
+             num_threads, num_interop_threads):
+    pipe = load_whisper_model(**options, num_threads=num_threads,
+                              num_interop_threads=num_interop_threads)
+
+    # Warm up, the first call compiles the encoder when compile=True
+    transcribe(pipe, audio[:1], batch_size=1)
+
+    start = time.perf_counter()
+    texts = transcribe(pipe, audio, batch_size)
+    elapsed = time.perf_counter() - start
+
+    num_tokens = sum(len(pipe.tokenizer.encode(text, add_special_tokens=False))
+                     for text in texts)
+    hypotheses = [normalize(text) for text in texts]
+    wer = jiwer.wer(references, hypotheses)
+    print(f'{name}: {elapsed:.1f}s for {audio_seconds:.1f}s of audio, '
+          f'RTF {elapsed / audio_seconds:.3f}, {num_tokens / elapsed:.1f} tokens/s, WER {wer:.4f}')
+    return {'rtf': elapsed / audio_seconds, 'tokens_per_second': num_tokens / elapsed,
+            'wer': wer, 'texts': texts, 'hypotheses': hypotheses}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the real-time factor and WER of the Whisper CPU modes.")
+    parser.add_argument("--csv", default=SUBSET_CSV)
+    parser.add_argument("--num-files", type=int, default=SUBSET_SIZE)
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="comma separated list of: " + ", ".join(MODES))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--interop-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    paths, references = load_subset(args.csv, args.num_files)
+    references = [normalize(reference) for reference in references]
+    processed_files, _ = process_audio_files(paths)
+    audio = [audio_tensor.numpy() for audio_tensor in processed_files]
+    audio_seconds = sum(len(clip) for clip in audio) / 16000
+
+    # float32 is the baseline the other modes are compared to
+    modes = [mode.strip() for mode in args.modes.split(",")]
+    if 'float32' not in modes:
+        modes.insert(0, 'float32')
+    else:
+        modes.sort(key=lambda mode: mode != 'float32')
+
+    results = {}
+    for mode in modes:
+        options, batch_size = MODES[mode]
+        results[mode] = run_mode(mode, options, batch_size, audio, references, audio_seconds,
+                                 args.threads, args.interop_threads)
+
+    base = results['float32']
+    print(f'\n{"mode":<15}{"RTF":>8}{"speedup":>9}{"tokens/s":>10}{"WER":>8}{"dWER":>9}'
+          f'{"vs float32":>12}')
+    for mode, result in results.items():
+        # How much the transcripts differ from the float32 ones, jiwer needs non-empty references
+        pairs = [(reference, hypothesis) for reference, hypothesis
+                 in zip(base['hypotheses'], result['hypotheses']) if reference]
+        drift = jiwer.wer(*map(list, zip(*pairs))) if pairs else 0.0
+        print(f'{mode:<15}{result["rtf"]:>8.3f}{base["rtf"] / result["rtf"]:>8.2f}x'
+              f'{result["tokens_per_second"]:>10.1f}{result["wer"]:>8.4f}'
+              f'{result["wer"] - base["wer"]:>+9.4f}{drift:>12.4f}')
+
+    if 'assisted' in results and 'greedy-bs1' in results:
+        greedy = results['greedy-bs1']
+        assisted = results['assisted']
+        identical = sum(a == b for a, b in zip(greedy['texts'], assisted['texts']))
+        print(f'\nAssisted decoding: {assisted["tokens_per_second"] / greedy["tokens_per_second"]:.2f}x '
+              f'the tokens/s of greedy decoding, {identical}/{len(audio)} transcripts identical')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import jiwer
 import json
+import os
+from confusion_index import ConfusionIndex, alignment_edits
+
+
+SCORE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+SCORE_CHUNK = 500  # Pairs per task of the process pool, smaller corpora are scored in process
+COUNT_KEYS = ('hits', 'substitutions', 'deletions', 'insertions',
+              'char_hits', 'char_substitutions', 'char_deletions', 'char_insertions')
 
 words = ['ik', 'hij', 'zij', 'aan', 'achter', 'bij', 'binnen', 'boven',
          "buiten", "dankzij", "door", "gedurende", "in", "langs", "naar", "nabij",
@@ -12,10 +20,90 @@ words = ['ik', 'hij', 'zij', 'aan', 'achter', 'bij', 'binnen', 'boven',
          "tenzij", 'de', 'het', 'een', 'uh', 'dat', 'ja', 'nee', 'dan']
 
 
-def calculate_wer(reference_path, generated_path):
+def score_pair(reference, hypothesis):
+    '''
+    Aligns a reference and a hypothesis once at the word level and once at the
+    character level, and returns the edit operation counts WER, MER and CER follow from,
+    with the reference words and word edits for the confusion index.
+    '''
+    words_output = jiwer.process_words(reference, hypothesis)
+    chars_output = jiwer.process_characters(reference, hypothesis)
+    return {'hits': words_output.hits,
+            'substitutions': words_output.substitutions,
+            'deletions': words_output.deletions,
+            'insertions': words_output.insertions,
+            'char_hits': chars_output.hits,
+            'char_substitutions': chars_output.substitutions,
+            'char_deletions': chars_output.deletions,
+            'char_insertions': chars_output.insertions,
+            'reference_words': words_output.references[0],
+            'edits': alignment_edits(words_output)}
+
+
+def score_pairs(pairs):
+    return [score_pair(reference, hypothesis) for reference, hypothesis in pairs]
+
+
+def score_corpus(pairs, workers=SCORE_WORKERS, chunk_size=SCORE_CHUNK):
+    '''
+    Returns the counts of score_pair for every (reference, hypothesis) pair,
+    scored in chunks on a process pool.
+    '''
+    if workers <= 1 or len(pairs) <= chunk_size:
+        return score_pairs(pairs)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [counts for chunk in executor.map(score_pairs, chunks) for counts in chunk]
+
+
+def rates(counts):
+    '''
+    WER, MER and CER of edit operation counts, of one pair or summed over a corpus.
+    '''
+    errors = counts['substitutions'] + counts['deletions'] + counts['insertions']
+    char_errors = (counts['char_substitutions'] + counts['char_deletions']
+                   + counts['char_insertions'])
+    ref_words = counts['hits'] + counts['substitutions'] + counts['deletions']
+    ref_chars = counts['char_hits'] + counts['char_substitutions'] + counts['char_deletions']
+    return (errors / ref_words if ref_words else float(errors > 0),
+            errors / (ref_words + counts['insertions']) if errors else 0.0,
+            char_errors / ref_chars if ref_chars else float(char_errors > 0))
+
+
+def corpus_rates(wer_list):
+    '''
+    Corpus-level (micro-averaged) WER, MER and CER: the errors of all files over the
+    words of all files, so long files weigh more than in the per-file averages.
+    '''
+    totals = {key: sum(item['counts'][key] for item in wer_list) for key in COUNT_KEYS}
+    return rates(totals)
+
+
+def print_confusions(index, top_n=10):
+    print(f"\nTop {top_n} most wrongly transcribed words:")
+    for word, errors, occurrences in index.top_errors(top_n):
+        substitutions = ', '.join(f'{hyp} {count}' for hyp, count in index.lookup(word, 3)['substitutions'])
+        print(f"{word}: {errors} ({errors}/{occurrences})"
+              + (f" -> {substitutions}" if substitutions else ""))
+
+    print(f"\nTop {top_n} most wrongly transcribed function words:")
+    for word, errors, occurrences in index.top_errors(top_n, words):
+        print(f"{word}: {errors} ({errors}/{occurrences}), "
+              f"{index.lookup(word)['deletions']} deleted")
+
+    print(f"\nTop {top_n} most inserted words:")
+    for word, count in index.top_insertions(top_n):
+        print(f"{word}: {count}")
+
+
+def calculate_wer(reference_path, generated_path, index=None):
+    '''
+    Returns the WER, MER and CER per file. The word errors of the alignments are
+    added to the ConfusionIndex `index`, a new one when it isn't given.
+    '''
     wer_dict = {}
-    # Using defaultdict for error_words
-    error_words = defaultdict(lambda: [0, 0])
+    if index is None:
+        index = ConfusionIndex()
 
     with open(reference_path, 'r') as ref_file, open(generated_path, 'r') as gen_file:
         ref_content = ref_file.readlines()
@@ -38,11 +126,6 @@ def calculate_wer(reference_path, generated_path):
             continue
         reference_dict[key] = value
 
-        # Count the absolute occurrences of each word in the reference
-        ref_words = value.split()
-        for word in ref_words:
-            error_words[word][1] += 1
-
     for gen_line in gen_content:
         if "|" not in gen_line:
             print(
@@ -57,48 +140,39 @@ def calculate_wer(reference_path, generated_path):
             continue
         generated_dict[key] = value
 
+    pairs = []
     for ref_key, ref_value in reference_dict.items():
         if ref_key not in generated_dict:
             print(f"Key '{ref_key}' not found in `generated_dict`")
             with open('./not_in_trans.txt', 'a') as f:
                 f.write(f'{ref_key} \n')
             continue
+        pairs.append((ref_key, ref_value, generated_dict[ref_key]))
 
-        gen_value = generated_dict[ref_key]
+    # Every pair is aligned once, all measures come from the same edit operations
+    scores = score_corpus([(ref_value, gen_value) for _, ref_value, gen_value in pairs])
 
-        wer = jiwer.wer(ref_value, gen_value)
-        mer = jiwer.mer(ref_value, gen_value)
-        cer = jiwer.cer(ref_value, gen_value)
+    for (ref_key, ref_value, gen_value), counts in zip(pairs, scores):
+        wer, mer, cer = rates(counts)
 
         if ref_key in wer_dict:
-            wer_dict[ref_key].append((wer, mer, cer, ref_value, gen_value))
+            wer_dict[ref_key].append((wer, mer, cer, ref_value, gen_value, counts))
         else:
-            wer_dict[ref_key] = [(wer, mer, cer, ref_value, gen_value)]
+            wer_dict[ref_key] = [(wer, mer, cer, ref_value, gen_value, counts)]
 
-        # Identify the most wrongly transcribed words based on the reference
-        gt_words = ref_value.split()
-        hyp_words = gen_value.split()
-        updated_words = set()  # To keep track of already updated words
-        for gt, hyp in zip(gt_words, hyp_words):
-            if gt != hyp and gt not in updated_words:
-                error_words[gt][0] += 1  # Incrementing absolute count
-                updated_words.add(gt)     # Marking word as updated
+        # Substitutions, deletions and insertions from the alignment, not by position
+        index.add(counts['reference_words'], counts['edits'])
 
     wer_list = [{'filename': filename,
                  'wer': sum([item[0] for item in wer_scores]) / len(wer_scores),
                  'mer': sum([item[1] for item in wer_scores]) / len(wer_scores),
                  'cer': sum([item[2] for item in wer_scores]) / len(wer_scores),
                  'ref_line': [item[3] for item in wer_scores],
-                 'gen_line': [item[4] for item in wer_scores]}
+                 'gen_line': [item[4] for item in wer_scores],
+                 'counts': {key: sum(item[5][key] for item in wer_scores) for key in COUNT_KEYS}}
                 for filename, wer_scores in wer_dict.items()]
 
-    # Display the top 5 most wrongly transcribed words
-    top_n = 10
-    print(f"\nTop {top_n} most wrongly transcribed words:")
-    sorted_error_words = sorted(
-        error_words.items(), key=lambda x: x[1][0], reverse=True)
-    for word, counts in sorted_error_words[:top_n]:
-        print(f"{word}: {counts[0]} ({counts[0]}/{counts[1]})")
+    print_confusions(index)
 
     return wer_list
 
@@ -128,8 +202,9 @@ def main():
         ref_trans = './data/dialectloket_trans.txt'
 
     gen_trans = input('generated transcripts path: ')
+    index = ConfusionIndex()
     wer_scores = calculate_wer(
-        ref_trans, gen_trans)
+        ref_trans, gen_trans, index)
 
     average_wer = sum(item['wer'] for item in wer_scores) / len(wer_scores)
     average_mer = sum(item['mer'] for item in wer_scores) / len(wer_scores)
@@ -139,8 +214,15 @@ def main():
     print("Average MER:", average_mer)
     print(f"Average CER: {average_cer}%")
 
+    corpus_wer, corpus_mer, corpus_cer = corpus_rates(wer_scores)
+    print("\nCorpus WER:", corpus_wer)
+    print("Corpus MER:", corpus_mer)
+    print("Corpus CER:", corpus_cer)
+
     save_loc = input('Where do you want to save it: ')
     save_wer_results(wer_scores, save_loc)
+    # The confusions can be queried later with ConfusionIndex.load
+    index.save(os.path.splitext(save_loc)[0] + '_confusions.json')
 
 
 if __name__ == "__main__":
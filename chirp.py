@@ -1,81 +1,95 @@
 import os
-import asyncio
 from glob import glob
-from google.api_core.client_options import ClientOptions
-from google.cloud.speech_v2 import SpeechClient
 from google.cloud.speech_v2.types import cloud_speech
+from async_scheduler import run_sliding_window
+from google_clients import emulator_host, get_client
+from rate_control import RateController
+from response_cache import ResponseCache
+from upload_encode import UploadEncoder
+from journal import open_journal
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "C:/Users/jensc/AppData/Roaming/gcloud/application_default_credentials.json"
 
 # Adjust wait settings
-WAIT_TIME = 10  # Wait for 10 seconds to retry
-BATCH_SIZE = 30
-RETRY_LIMIT = 1  # Number of times to retry
+WAIT_TIME = 10  # The first retry waits up to 10 seconds, doubling with every retry
+CONCURRENCY = 30  # Requests in flight at the start, adapted to the throttling
+MAX_CONCURRENCY = 100
+REQUESTS_PER_SECOND = None  # The quota of the project, None leaves it to the concurrency limit
+RETRY_LIMIT = 3  # Retries of a failed request, throttled requests get MAX_THROTTLED_RETRIES
+HEDGE_BUDGET = None  # 0.05 sends up to 5% extra requests to duplicate the slowest ones, None turns it off
+UPLOAD_FORMAT = None  # 'flac' compresses the audio before uploading, None sends the .wav files as is
+UPLOAD_SAMPLE_RATE = None  # Resample before uploading, None keeps the rate of the file
+
+RECOGNITION_CONFIG = dict(language_codes=["nl-NL"], model="chirp")
+API_ENDPOINT = "europe-west4-speech.googleapis.com"
 
 
 def sanitize_filename(filename):
     return "".join([c for c in filename if c.isalpha() or c.isdigit() or c in [' ', '_', '-']]).rstrip()
 
 
+def get_journal(file_path):
+    '''
+    Returns the journal of the transcript file this audio file is written to.
+    '''
+    # Extract folder name
+    folder_name = os.path.dirname(file_path)
+
+    # Sanitize folder name
+    sanitized_folder_name = sanitize_filename(folder_name)
+
+    return open_journal(f'./chirp_transcripts_{sanitized_folder_name}.txt',
+                        'chirp', RECOGNITION_CONFIG, emulator_host())
+
+
+async def recognize_chirp(content):
+    """Sends one recognize request with these audio bytes, returns the raw response."""
+    # A shared async client for the Chirp region
+    client = get_client('v2', API_ENDPOINT)
+
+    config = cloud_speech.RecognitionConfig(
+        auto_decoding_config=cloud_speech.AutoDetectDecodingConfig(),
+        **RECOGNITION_CONFIG,
+    )
+
+    request = cloud_speech.RecognizeRequest(
+        recognizer=f"projects/vaulted-botany-416808/locations/europe-west4/recognizers/_",
+        config=config,
+        content=content,
+    )
+
+    # Transcribes the audio into text
+    return await client.recognize(request=request)
+
+
 async def transcribe_chirp_async(audio_file: str):
     """Transcribe an audio file using Chirp asynchronously."""
-    retries = 0
-    while retries < RETRY_LIMIT:
-        try:
-            # Instantiates a client
-            client = SpeechClient(
-                client_options=ClientOptions(
-                    api_endpoint="europe-west4-speech.googleapis.com",
-                )
-            )
-
-            # Reads a file as bytes
-            with open(audio_file, "rb") as f:
-                content = f.read()
-
-            config = cloud_speech.RecognitionConfig(
-                auto_decoding_config=cloud_speech.AutoDetectDecodingConfig(),
-                language_codes=["nl-NL"],
-                model="chirp",
-            )
-
-            request = cloud_speech.RecognizeRequest(
-                recognizer=f"projects/vaulted-botany-416808/locations/europe-west4/recognizers/_",
-                config=config,
-                content=content,
-            )
-
-            # Transcribes the audio into text
-            response = client.recognize(request=request)
-
-            transcripts = []
-            for result in response.results:
-                transcript = result.alternatives[0].transcript
-                transcripts.append(transcript)
-                # print(f"Transcript: {transcript}")
-
-            # Extract folder name
-            folder_name = os.path.dirname(audio_file)
-
-            # Sanitize folder name
-            sanitized_folder_name = sanitize_filename(folder_name)
-
-            # Write transcripts to file
-            with open(f'./chirp_transcripts_{sanitized_folder_name}.txt', 'a') as f:
-                f.write(
-                    f"{os.path.basename(audio_file)}|{' |'.join(transcripts)}\n")
-
-            return transcripts
-        except Exception as e:
-            print(
-                f'Failed to transcribe {audio_file} due to {type(e).__name__}: {e}')
-            retries += 1
-            if retries < RETRY_LIMIT:
-                print(f'Retrying... Attempt {retries}')
-                await asyncio.sleep(WAIT_TIME)
-            else:
-                print(f'Retry limit reached. Moving to next file.')
-                return None  # Returning None to signify failure
+    async def request():
+        # The file as is, or converted by the encode stage, Chirp detects the format.
+        # Encoded once before the rate controller, so retries and hedges send the same bytes
+        content = await upload_encoder.read(audio_file)
+        return await rate_control.call(recognize_chirp, content)
+
+    try:
+        # Replayed from disk when this audio was sent with the same config before,
+        # otherwise retried and throttled by the rate controller
+        response = await response_cache.fetch(audio_file, request)
+    except Exception as e:
+        print(
+            f'Failed to transcribe {audio_file} due to {type(e).__name__}: {e}. Moving to next file.')
+        return None  # Returning None to signify failure
+
+    transcripts = []
+    for result in response.results:
+        transcript = result.alternatives[0].transcript
+        transcripts.append(transcript)
+        # print(f"Transcript: {transcript}")
+
+    # Write transcripts to file
+    get_journal(audio_file).write(
+        os.path.basename(audio_file), ' |'.join(transcripts))
+
+    return transcripts
 
 
 async def process_file(file_path):
@@ -83,23 +97,35 @@ async def process_file(file_path):
     return await transcribe_chirp_async(file_path)
 
 
-async def process_batch(batch_files):
-    """Process a batch of files asynchronously."""
-    await asyncio.gather(*[process_file(file_path) for file_path in batch_files])
-
-
 async def process_audio(data):
     """Process audio files asynchronously."""
+    global rate_control, response_cache, upload_encoder
+    upload_encoder = UploadEncoder('chirp', UPLOAD_FORMAT, UPLOAD_SAMPLE_RATE)
+    cache_config = {'endpoint': API_ENDPOINT, 'decoding': 'auto', **RECOGNITION_CONFIG}
+    if upload_encoder.format:
+        cache_config['upload'] = [upload_encoder.format, UPLOAD_SAMPLE_RATE]
+    response_cache = ResponseCache(
+        'chirp', cache_config,
+        dumps=cloud_speech.RecognizeResponse.to_json,
+        loads=cloud_speech.RecognizeResponse.from_json,
+        stand_in=emulator_host())
+    rate_control = RateController('chirp', CONCURRENCY, MAX_CONCURRENCY, REQUESTS_PER_SECOND,
+                                  RETRY_LIMIT, WAIT_TIME, hedge_budget=HEDGE_BUDGET)
+
     if isinstance(data, list):  # If data is a list of file paths
         files = data
     else:
         files = glob(os.path.join(data, '*.wav'))
-
-    # Split files into batches
-    num_files = len(files)
-    for i in range(0, num_files, BATCH_SIZE):
-        batch_files = files[i:i+BATCH_SIZE]
-        print(f'Processing batch {i//BATCH_SIZE + 1}...')
-
-        # Process batch asynchronously
-        await process_batch(batch_files)
+    # Skip the files a previous run already transcribed
+    files = [file_path for file_path in files
+             if not get_journal(file_path).is_done(os.path.basename(file_path))]
+
+    # Enough files in progress for the highest concurrency, the rate controller decides
+    # how many requests are sent at once
+    try:
+        await run_sliding_window(files, process_file, MAX_CONCURRENCY, 'chirp')
+    finally:
+        upload_encoder.close()
+    rate_control.report()
+    response_cache.report()
+    upload_encoder.report()
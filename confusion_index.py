@@ -0,0 +1,118 @@
+import heapq
+import json
+from collections import Counter, defaultdict
+
+
+DELETED = -1  # Hypothesis id of a deleted reference word
+INSERTED = -2  # Reference id of an inserted hypothesis word
+
+
+def alignment_edits(words_output):
+    '''
+    Returns the edits of a jiwer.process_words alignment of one pair as
+    (reference word, hypothesis word) tuples, with None for the missing side
+    of a deletion or insertion.
+    '''
+    reference = words_output.references[0]
+    hypothesis = words_output.hypotheses[0]
+    edits = []
+    for chunk in words_output.alignments[0]:
+        if chunk.type == 'substitute':
+            edits.extend(zip(reference[chunk.ref_start_idx:chunk.ref_end_idx],
+                             hypothesis[chunk.hyp_start_idx:chunk.hyp_end_idx]))
+        elif chunk.type == 'delete':
+            edits.extend((word, None) for word in reference[chunk.ref_start_idx:chunk.ref_end_idx])
+        elif chunk.type == 'insert':
+            edits.extend((None, word) for word in hypothesis[chunk.hyp_start_idx:chunk.hyp_end_idx])
+    return edits
+
+
+class ConfusionIndex:
+    '''
+    Word errors of a corpus from the alignments of its pairs: per reference word how
+    often it occurs, which words it was substituted by, how often it was deleted,
+    and which words were inserted. Words are stored once as ids, the counts per id,
+    so top-N and per-word lookups don't go over the transcripts again.
+    add() updates it pair by pair, save() and load() keep it between runs.
+    '''
+
+    def __init__(self):
+        self.vocabulary = []
+        self.ids = {}
+        self.occurrences = []
+        self.errors = []
+        # Reference id (or INSERTED) -> Counter of hypothesis ids (or DELETED)
+        self.confusions = defaultdict(Counter)
+
+    def word_id(self, word):
+        if word not in self.ids:
+            self.ids[word] = len(self.vocabulary)
+            self.vocabulary.append(word)
+            self.occurrences.append(0)
+            self.errors.append(0)
+        return self.ids[word]
+
+    def add(self, reference_words, edits):
+        '''
+        Adds one aligned pair: the words of the reference and its alignment_edits.
+        '''
+        for word in reference_words:
+            self.occurrences[self.word_id(word)] += 1
+        for ref_word, hyp_word in edits:
+            ref_id = INSERTED if ref_word is None else self.word_id(ref_word)
+            hyp_id = DELETED if hyp_word is None else self.word_id(hyp_word)
+            self.confusions[ref_id][hyp_id] += 1
+            if ref_id != INSERTED:
+                self.errors[ref_id] += 1
+
+    def top_errors(self, n=10, words=None):
+        '''
+        Returns (word, errors, occurrences) of the n reference words with the most
+        substitutions and deletions, only among `words` when given.
+        '''
+        ids = range(len(self.vocabulary)) if words is None else \
+            {self.ids[word] for word in words if word in self.ids}
+        top = heapq.nlargest(n, ids, key=self.errors.__getitem__)
+        return [(self.vocabulary[i], self.errors[i], self.occurrences[i]) for i in top]
+
+    def top_insertions(self, n=10):
+        return [(self.vocabulary[i], count)
+                for i, count in self.confusions[INSERTED].most_common(n)]
+
+    def lookup(self, word, n=5):
+        '''
+        Returns the occurrences, errors, deletions and the n most frequent
+        substitutions of a reference word.
+        '''
+        if word not in self.ids:
+            return {'occurrences': 0, 'errors': 0, 'deletions': 0, 'substitutions': []}
+        i = self.ids[word]
+        confusions = self.confusions.get(i, Counter())
+        return {'occurrences': self.occurrences[i],
+                'errors': self.errors[i],
+                'deletions': confusions[DELETED],
+                'substitutions': [(self.vocabulary[hyp_id], count)
+                                  for hyp_id, count in confusions.most_common(n + 1)
+                                  if hyp_id != DELETED][:n]}
+
+    def save(self, path):
+        confusions = [[ref_id, hyp_id, count]
+                      for ref_id, counter in self.confusions.items()
+                      for hyp_id, count in counter.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'vocabulary': self.vocabulary, 'occurrences': self.occurrences,
+                       'confusions': confusions}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for word in data['vocabulary']:
+            index.word_id(word)
+        index.occurrences = data['occurrences']
+        for ref_id, hyp_id, count in data['confusions']:
+            index.confusions[ref_id][hyp_id] += count
+            if ref_id != INSERTED:
+                index.errors[ref_id] += count
+        return index
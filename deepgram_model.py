@@ -1,75 +1,118 @@
-import asyncio
 import os
 from glob import glob
-from deepgram import DeepgramClient, PrerecordedOptions
+import aiohttp
+from async_scheduler import run_sliding_window
+from rate_control import RateController
+from response_cache import ResponseCache
+from journal import open_journal
 
 DEEPGRAM_API_KEY = ''
+DEFAULT_API_URL = 'https://api.deepgram.com/v1/listen'
+# Point this at a local stand-in server to test without the real API
+DEEPGRAM_API_URL = os.environ.get('DEEPGRAM_API_URL', DEFAULT_API_URL)
 
 
 # Adjust wait settings
-WAIT_TIME = 5  # Wait for 10 seconds to retry
-BATCH_SIZE = 20
-RETRY_LIMIT = 3  # Number of times to retry
+WAIT_TIME = 5  # The first retry waits up to 5 seconds, doubling with every retry
+CONCURRENCY = 20  # Requests in flight at the start, adapted to the throttling
+MAX_CONCURRENCY = 100  # Deepgram's limit of concurrent pre-recorded requests
+REQUESTS_PER_SECOND = None  # None leaves the rate to the concurrency limit
+RETRY_LIMIT = 3  # Retries of a failed request, throttled requests get MAX_THROTTLED_RETRIES
+HEDGE_BUDGET = None  # 0.05 sends up to 5% extra requests to duplicate the slowest ones, None turns it off
+
+REQUEST_TIMEOUT = 600  # Long clips take a while to transcribe
+CHUNK_SIZE = 64 * 1024  # The upload is read from disk in chunks of this size
+
+OUTPUT_FILE = './deepgram.txt'
+OPTIONS = dict(punctuate=True, model="nova-2", language="nl")
+
+
+async def file_chunks(file_path):
+    # Streams the file into the request body without reading it into memory
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+async def request_file(file_path):
+    '''
+    Sends one pre-recorded request on the shared keep-alive session,
+    returns the JSON response of Deepgram.
+    '''
+    params = {name: str(value).lower() if isinstance(value, bool) else value
+              for name, value in OPTIONS.items()}
+    headers = {'Content-Type': 'audio/wav',
+               'Content-Length': str(os.path.getsize(file_path))}
+    # Every attempt reads the file from the start
+    async with session.post(DEEPGRAM_API_URL, params=params, headers=headers,
+                            data=file_chunks(file_path)) as response:
+        # Errors go to the rate controller with their status and Retry-After header
+        response.raise_for_status()
+        return await response.json()
+
+
+async def transcribe_file(file_path):
+    # Replayed from disk when this audio was sent with the same options before,
+    # otherwise retried and throttled by the rate controller
+    response = await response_cache.fetch(
+        file_path, lambda: rate_control.call(request_file, file_path))
+    return response['results']['channels'][0]['alternatives'][0]['transcript']
 
 
 async def process_file(file_path):
-    retries = 0
-    while retries < RETRY_LIMIT:
-        with open(file_path, 'rb') as buffer_data:
-            options = PrerecordedOptions(
-                punctuate=True, model="nova-2", language="nl"
-            )
-
-            print(f'Requesting transcript for {file_path}...')
-            print('Your file may take some time to process.')
-
-            try:
-                asyncio.sleep(2)
-                response = await asyncio.to_thread(
-                    deepgram.listen.prerecorded.v('1').transcribe_file,
-                    {'buffer': buffer_data}, options)
-                asyncio.sleep(2)
-                transcript = response.results.channels[0].alternatives[0].transcript
-                print(f'Transcript for {file_path}: {transcript}')
-
-                # Write transcript to file
-                with open('./deepgram.txt', 'a') as f:
-                    f.write(f"{os.path.basename(file_path)}|{transcript}\n")
-
-                break  # Break out of the loop if successful
-
-            except Exception as e:
-                print(
-                    f'Failed to transcribe {file_path} due to {type(e).__name__}: {e}')
-                retries += 1
-                if retries < RETRY_LIMIT:
-                    print(f'Retrying... Attempt {retries}')
-                    await asyncio.sleep(WAIT_TIME)
-                else:
-                    print(f'Retry limit reached. Moving to next file.')
-                    break
-
-
-async def process_batch(batch_files):
-    await asyncio.gather(*[process_file(file_path) for file_path in batch_files])
+    print(f'Requesting transcript for {file_path}...')
+    print('Your file may take some time to process.')
+
+    try:
+        transcript = await transcribe_file(file_path)
+    except Exception as e:
+        print(
+            f'Failed to transcribe {file_path} due to {type(e).__name__}: {e}. Moving to next file.')
+        return
+    print(f'Transcript for {file_path}: {transcript}')
+
+    # Write transcript to file
+    journal.write(os.path.basename(file_path), transcript)
+
+
+async def run_with_session(files):
+    '''
+    Transcribes the files over one HTTP session, its connections are kept alive
+    and reused by the following requests.
+    '''
+    global session
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            headers={'Authorization': f'Token {DEEPGRAM_API_KEY}'}) as session:
+        # Enough files in progress for the highest concurrency, the rate controller decides
+        # how many requests are sent at once
+        await run_sliding_window(files, process_file, MAX_CONCURRENCY, 'deepgram')
+
+
+def stand_in():
+    '''
+    Returns the URL of the stand-in server when DEEPGRAM_API_URL points at one, or None.
+    '''
+    return DEEPGRAM_API_URL if DEEPGRAM_API_URL != DEFAULT_API_URL else None
 
 
 async def process_audio(data):
-    # Load Deepgram client
-    global deepgram
-    deepgram = DeepgramClient(DEEPGRAM_API_KEY)
+    global journal, rate_control, response_cache
+    journal = open_journal(OUTPUT_FILE, 'deepgram', OPTIONS, stand_in())
+    # The raw JSON responses, the same as the ones the Deepgram SDK used to store
+    response_cache = ResponseCache('deepgram', OPTIONS, stand_in=stand_in())
+    rate_control = RateController('deepgram', CONCURRENCY, MAX_CONCURRENCY, REQUESTS_PER_SECOND,
+                                  RETRY_LIMIT, WAIT_TIME, hedge_budget=HEDGE_BUDGET)
 
     """Process audio files asynchronously."""
     if isinstance(data, list):  # If data is a list of file paths
         files = data
     else:
         files = glob(os.path.join(data, '*.wav'))
+    # Skip the files a previous run already transcribed
+    files = journal.pending(files)
 
-    # Split files into batches
-    num_files = len(files)
-    for i in range(0, num_files, BATCH_SIZE):
-        batch_files = files[i:i+BATCH_SIZE]
-        print(f'Processing batch {i//BATCH_SIZE + 1}...')
-
-        # Process batch asynchronously
-        await process_batch(batch_files)
+    await run_with_session(files)
+    rate_control.report()
+    response_cache.report()
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+CACHE_DIR = './feature_cache'
+# Oldest entries are evicted above 10 GB. Whisper features are cached without their
+# padding (see trim_frames), so cgn_cd takes about 2 GB and every corpus fits
+MAX_CACHE_BYTES = 10 * 1024 ** 3
+TMP_SUFFIX = '.tmp.npz'
+
+
+def config_id(feature_extractor):
+    '''
+    Hashes the settings of a transformers feature extractor, features computed
+    with other settings never match.
+    '''
+    config = feature_extractor.to_json_string().encode()
+    return hashlib.blake2b(config, digest_size=16).hexdigest()
+
+
+def trim_frames(features):
+    '''
+    Returns the cache entry of (bins, frames) features without the identical frames
+    at the end, the log-mel of the zeros a short clip is padded with.
+    pad_frames gives back exactly the same features.
+    '''
+    same = np.all(features == features[:, -1:], axis=0)
+    # Keep one copy of the repeated last frame
+    keep = 1 if same.all() else len(same) - int(np.argmin(same[::-1])) + 1
+    return {'input_features': features[:, :keep], 'num_frames': np.array(features.shape[-1])}
+
+
+def pad_frames(entry):
+    features = entry['input_features']
+    missing = int(entry['num_frames']) - features.shape[-1]
+    return np.pad(features, ((0, 0), (0, missing)), mode='edge')
+
+
+class FeatureCache:
+    '''
+    On-disk cache of model input features, keyed by the hash of the audio
+    samples and of the feature extractor settings.
+    Every hit refreshes the modification time of the entry, when the cache grows
+    past max_bytes the least recently used entries are removed first.
+    Several workers can share the directory: an entry another worker removed in the
+    meantime is a miss, not an error.
+    '''
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        '''
+        Returns (modification time, size, path) of the finished entries.
+        '''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npz') or entry.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def key(self, samples, config):
+        digest = hashlib.blake2b(config.encode(), digest_size=20)
+        digest.update(np.ascontiguousarray(samples).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                features = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return features
+
+    def put(self, key, features):
+        path = self.path(key)
+        # np.savez adds .npz to names without it, the temporary name keeps the suffix.
+        # It is unique per worker, two workers can compute the same entry at once
+        tmp_path = f'{path[:-4]}.{os.getpid()}-{threading.get_ident()}{TMP_SUFFIX}'
+        np.savez(tmp_path, **features)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache is at 90% of max_bytes.
+        '''
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker evicted it first
+                pass
+            self.size -= size
+
+    def get_many(self, clips, config, compute):
+        '''
+        Returns the features of every clip, computing only the missing ones.
+        compute takes a list of clips and returns a dict of arrays per clip.
+        '''
+        keys = [self.key(clip, config) for clip in clips]
+        features = [self.get(key) for key in keys]
+
+        missing = [i for i, entry in enumerate(features) if entry is None]
+        self.hits += len(clips) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = compute([clips[i] for i in missing])
+            for i, entry in zip(missing, computed):
+                self.put(keys[i], entry)
+                features[i] = entry
+        return features
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            print(f'Feature cache: {self.hits}/{total} hits '
+                  f'({100 * self.hits / total:.1f}%), {self.size / 1024 ** 2:.0f} MB on disk')
@@ -0,0 +1,59 @@
+import asyncio
+import itertools
+import os
+import grpc
+from google.api_core.client_options import ClientOptions
+from google.cloud import speech_v1, speech_v2
+from google.cloud.speech_v1.services.speech.transports import \
+    SpeechGrpcAsyncIOTransport as SpeechV1Transport
+from google.cloud.speech_v2.services.speech.transports import \
+    SpeechGrpcAsyncIOTransport as SpeechV2Transport
+
+
+# host:port of a local stand-in server (see mock_asr_server.py), used instead of Google when set
+EMULATOR_ENV = 'SPEECH_EMULATOR_HOST'
+# Every client has its own gRPC channel, one HTTP/2 connection carries about 100 requests at once
+POOL_SIZE = 4
+
+CLIENT_CLASSES = {'v1': speech_v1.SpeechAsyncClient, 'v2': speech_v2.SpeechAsyncClient}
+TRANSPORT_CLASSES = {'v1': SpeechV1Transport, 'v2': SpeechV2Transport}
+
+_pools = {}
+
+
+def emulator_host():
+    '''
+    Returns the host:port of the stand-in server in SPEECH_EMULATOR_HOST, or None.
+    '''
+    return os.environ.get(EMULATOR_ENV) or None
+
+
+def create_client(version, api_endpoint=None):
+    '''
+    Returns a new async Speech client of the given API version ('v1' or 'v2').
+    With SPEECH_EMULATOR_HOST set it talks to that server over a plain channel
+    without credentials.
+    '''
+    emulator = emulator_host()
+    if emulator:
+        channel = grpc.aio.insecure_channel(emulator)
+        return CLIENT_CLASSES[version](transport=TRANSPORT_CLASSES[version](channel=channel))
+
+    client_options = ClientOptions(api_endpoint=api_endpoint) if api_endpoint else None
+    return CLIENT_CLASSES[version](client_options=client_options)
+
+
+def get_client(version, api_endpoint=None):
+    '''
+    Returns one of POOL_SIZE shared async clients, in turn.
+    The clients are created on first use and reused for every request.
+    gRPC channels belong to the event loop that created them, every loop gets its own pool.
+    '''
+    loop = asyncio.get_running_loop()
+    for closed in [key for key in _pools if key[2].is_closed()]:
+        del _pools[closed]
+    key = (version, api_endpoint, loop)
+    if key not in _pools:
+        clients = [create_client(version, api_endpoint) for _ in range(POOL_SIZE)]
+        _pools[key] = itertools.cycle(clients)
+    return next(_pools[key])
@@ -1,32 +1,58 @@
 from google.cloud import speech
 import os
 from glob import glob
-import asyncio
 import soundfile as sf
+from async_scheduler import run_sliding_window
+from google_clients import emulator_host, get_client
+from rate_control import RateController
+from response_cache import ResponseCache
+from upload_encode import UploadEncoder
+from journal import open_journal
 
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "C:/Users/jensc/AppData/Roaming/gcloud/application_default_credentials.json"
 
 # Adjust wait settings
-WAIT_TIME = 10  # Wait for 10 seconds to retry
-BATCH_SIZE = 30
-RETRY_LIMIT = 3  # Number of times to retry
+WAIT_TIME = 10  # The first retry waits up to 10 seconds, doubling with every retry
+CONCURRENCY = 30  # Requests in flight at the start, adapted to the throttling
+MAX_CONCURRENCY = 100
+REQUESTS_PER_SECOND = None  # The quota of the project, None leaves it to the concurrency limit
+RETRY_LIMIT = 3  # Retries of a failed request, throttled requests get MAX_THROTTLED_RETRIES
+HEDGE_BUDGET = None  # 0.05 sends up to 5% extra requests to duplicate the slowest ones, None turns it off
+UPLOAD_FORMAT = None  # 'flac' compresses the audio before uploading, None sends the .wav files as is
+UPLOAD_SAMPLE_RATE = None  # Resample before uploading, None keeps the rate of the file
 
+RECOGNITION_CONFIG = dict(language_code="nl-NL", model="latest_long")
 
-def transcribe_file(speech_file):
-    """Transcribe the given audio file."""
-    client = speech.SpeechClient()
 
-    with open(speech_file, "rb") as audio_file:
-        content = audio_file.read()
+async def recognize_file(content):
+    """Sends the given audio bytes to the API, returns the raw response."""
+    # A shared async client, the request doesn't block the other files
+    client = get_client('v1')
 
     audio = speech.RecognitionAudio(content=content)
     config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        language_code="nl-NL",
-        model="latest_long"
+        encoding=speech.RecognitionConfig.AudioEncoding[upload_encoding()],
+        **RECOGNITION_CONFIG
     )
-    response = client.recognize(config=config, audio=audio)
+    return await client.recognize(config=config, audio=audio)
+
+
+def upload_encoding():
+    return 'FLAC' if UPLOAD_FORMAT == 'flac' else 'LINEAR16'
+
+
+async def transcribe_file(speech_file):
+    """Transcribe the given audio file."""
+    async def request():
+        # The file as is, or converted by the encode stage. Encoded once before the
+        # rate controller, so retries and hedges send the same bytes
+        content = await upload_encoder.read(speech_file)
+        return await rate_control.call(recognize_file, content)
+
+    # Replayed from disk when this audio was sent with the same config before,
+    # otherwise retried and throttled by the rate controller
+    response = await response_cache.fetch(speech_file, request)
 
     # Each result is for a consecutive portion of the audio. Iterate through
     # them to get the transcripts for the entire audio file.
@@ -39,52 +65,61 @@ def sanitize_filename(filename):
     return "".join([c for c in filename if c.isalpha() or c.isdigit() or c in [' ', '_', '-']]).rstrip()
 
 
-async def process_file(file_path):
-    retries = 0
-    while retries < RETRY_LIMIT:
-        try:
-            transcript = transcribe_file(file_path)
-            # print(f'Transcript for {file_path}: {transcript}')
-
-            # Extract folder name
-            folder_name = os.path.dirname(file_path)
+def get_journal(file_path):
+    '''
+    Returns the journal of the transcript file this audio file is written to.
+    '''
+    # Extract folder name
+    folder_name = os.path.dirname(file_path)
 
-            # Sanitize folder name
-            sanitized_folder_name = sanitize_filename(folder_name)
+    # Sanitize folder name
+    sanitized_folder_name = sanitize_filename(folder_name)
 
-            # Write transcript to file
-            with open(f'./google_transcripts_{sanitized_folder_name}.txt', 'a') as f:
-                f.write(f"{os.path.basename(file_path)}|{transcript}\n")
+    return open_journal(f'./google_transcripts_{sanitized_folder_name}.txt',
+                        'google', RECOGNITION_CONFIG, emulator_host())
 
-            break  # Break out of the loop if successful
-        except Exception as e:
-            print(
-                f'Failed to transcribe {file_path} due to {type(e).__name__}: {e}')
-            retries += 1
-            if retries < RETRY_LIMIT:
-                print(f'Retrying... Attempt {retries}')
-                await asyncio.sleep(WAIT_TIME)
-            else:
-                print(f'Retry limit reached. Moving to next file.')
-                break
 
+async def process_file(file_path):
+    try:
+        transcript = await transcribe_file(file_path)
+    except Exception as e:
+        print(
+            f'Failed to transcribe {file_path} due to {type(e).__name__}: {e}. Moving to next file.')
+        return
+    # print(f'Transcript for {file_path}: {transcript}')
 
-async def process_batch(batch_files):
-    await asyncio.gather(*[process_file(file_path) for file_path in batch_files])
+    # Write transcript to file
+    get_journal(file_path).write(os.path.basename(file_path), transcript)
 
 
 async def process_audio(data):
     """Process audio files asynchronously."""
+    global rate_control, response_cache, upload_encoder
+    upload_encoder = UploadEncoder('google', UPLOAD_FORMAT, UPLOAD_SAMPLE_RATE)
+    cache_config = {'encoding': upload_encoding(), **RECOGNITION_CONFIG}
+    if UPLOAD_SAMPLE_RATE:
+        cache_config['upload_sample_rate'] = UPLOAD_SAMPLE_RATE
+    response_cache = ResponseCache(
+        'google', cache_config,
+        dumps=speech.RecognizeResponse.to_json, loads=speech.RecognizeResponse.from_json,
+        stand_in=emulator_host())
+    rate_control = RateController('google', CONCURRENCY, MAX_CONCURRENCY, REQUESTS_PER_SECOND,
+                                  RETRY_LIMIT, WAIT_TIME, hedge_budget=HEDGE_BUDGET)
+
     if isinstance(data, list):  # If data is a list of file paths
         files = data
     else:
         files = glob(os.path.join(data, '*.wav'))
-
-    # Split files into batches
-    num_files = len(files)
-    for i in range(0, num_files, BATCH_SIZE):
-        batch_files = files[i:i+BATCH_SIZE]
-        print(f'Processing batch {i//BATCH_SIZE + 1}...')
-
-        # Process batch asynchronously
-        await process_batch(batch_files)
+    # Skip the files a previous run already transcribed
+    files = [file_path for file_path in files
+             if not get_journal(file_path).is_done(os.path.basename(file_path))]
+
+    # Enough files in progress for the highest concurrency, the rate controller decides
+    # how many requests are sent at once
+    try:
+        await run_sliding_window(files, process_file, MAX_CONCURRENCY, 'google')
+    finally:
+        upload_encoder.close()
+    rate_control.report()
+    response_cache.report()
+    upload_encoder.report()
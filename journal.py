@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import threading
+
+
+JOURNAL_DIR = './journal'
+# Outputs, journals and response caches of runs against a stand-in server (see mock_asr_server.py)
+STAND_IN_DIR = './stand_in'
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def config_hash(config):
+    '''
+    Short stable hash of a backend configuration (model, language, options, ...).
+    '''
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:10]
+
+
+def stand_in_path(path, stand_in):
+    '''
+    Returns where a file or directory of a run against the stand-in server at stand_in
+    goes: in STAND_IN_DIR, so mock transcripts never end up between the real ones.
+    Without a stand-in the path is returned unchanged.
+    '''
+    if not stand_in:
+        return path
+    return os.path.join(STAND_IN_DIR, os.path.basename(os.path.normpath(path)))
+
+
+def journal_path(output_path, backend, config=None, journal_dir=JOURNAL_DIR):
+    '''
+    Path of the journal of this output file, backend and config.
+    '''
+    # One journal per output file and config, so a new model or option starts fresh
+    name = f'{backend}-{config_hash([os.path.abspath(output_path), config])}'
+    return os.path.join(journal_dir, name + '.jsonl')
+
+
+def _read_lines(path):
+    '''
+    Returns the complete lines of a file, a partial last line left by a crash
+    is cut off the file so the next write starts on a new line.
+    '''
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end < len(content):
+            f.truncate(end)
+    return content[:end].decode('utf-8').splitlines()
+
+
+class TranscriptJournal:
+    '''
+    Crash-safe record of the files a backend has transcribed with a given config.
+    Every transcript is first appended to the journal and synced to disk, then written
+    to the output file. On restart finished files are skipped, transcripts that made it
+    into the journal but not into the output file are written out again, and a file is
+    never written twice.
+    '''
+
+    def __init__(self, output_path, backend, config=None, journal_dir=JOURNAL_DIR):
+        self.output_path = output_path
+        os.makedirs(journal_dir, exist_ok=True)
+        self.path = journal_path(output_path, backend, config, journal_dir)
+        self.lock = threading.Lock()
+        # Journaled transcripts that are not in the output file yet, see record_many
+        self.unwritten = {}
+
+        entries = [json.loads(line) for line in _read_lines(self.path)]
+        self.done = {filename for filename, _ in entries}
+
+        # Recover the transcripts the previous run journaled but did not write out
+        written = {line.split('|', 1)[0] for line in _read_lines(output_path)
+                   if '|' in line}
+        missing = [(filename, text) for filename, text in entries
+                   if filename not in written]
+        if missing:
+            with open(output_path, 'a') as f:
+                for filename, text in missing:
+                    f.write(f"{filename}|{text}\n")
+        if self.done:
+            print(f'{backend}: resuming, {len(self.done)} files already transcribed')
+
+    def is_done(self, filename):
+        return filename in self.done
+
+    def pending(self, paths):
+        '''
+        Returns the paths whose file name has not been transcribed yet.
+        '''
+        return [path for path in paths if os.path.basename(path) not in self.done]
+
+    def record_many(self, transcripts):
+        '''
+        Records a batch of (filename, transcript) pairs in the journal only, so they
+        survive a crash. They reach the output file with write_output, or on restart.
+        Files that are already done are skipped, returns the new pairs.
+        '''
+        with self.lock:
+            new = []
+            for filename, text in transcripts:
+                if filename not in self.done:
+                    self.done.add(filename)
+                    new.append((filename, text))
+            if not new:
+                return new
+
+            with open(self.path, 'a') as f:
+                for filename, text in new:
+                    f.write(json.dumps([filename, text]) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.unwritten.update(new)
+            return new
+
+    def write_output(self, filenames):
+        '''
+        Appends the recorded transcripts of these files to the output file, in this order.
+        '''
+        with self.lock:
+            lines = [f"{filename}|{self.unwritten.pop(filename)}\n"
+                     for filename in filenames if filename in self.unwritten]
+            if lines:
+                with open(self.output_path, 'a') as f:
+                    f.writelines(lines)
+
+    def write_many(self, transcripts):
+        '''
+        Records a batch of (filename, transcript) pairs and appends them to the output file.
+        Files that are already done are skipped.
+        '''
+        new = self.record_many(transcripts)
+        self.write_output([filename for filename, _ in new])
+
+    def write(self, filename, text):
+        self.write_many([(filename, text)])
+
+
+def open_journal(output_path, backend, config=None, stand_in=None):
+    '''
+    Returns the journal of this output file, backend and config, opened once per process.
+    stand_in is the endpoint of a stand-in server the backend talks to instead of the
+    real API, its output file and journal then go to STAND_IN_DIR.
+    '''
+    journal_dir = JOURNAL_DIR
+    if stand_in:
+        output_path = stand_in_path(output_path, stand_in)
+        journal_dir = stand_in_path(journal_dir, stand_in)
+        config = {'config': config, 'stand_in': stand_in}
+    key = (output_path, backend, config_hash(config))
+    with _journals_lock:
+        if key not in _journals:
+            _journals[key] = TranscriptJournal(output_path, backend, config, journal_dir)
+        return _journals[key]
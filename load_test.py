@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import importlib
+import os
+import tempfile
+import time
+from automate import CLOUD_BACKENDS, list_audio_files, read_audio_list
+from mock_asr_server import (HTTP_PORT, PORT, add_behaviour_arguments, behaviour_from_args,
+                             start_servers, stop_servers)
+
+
+NUM_FILES = 500
+
+
+def list_files(audio, num_files):
+    files = list_audio_files(read_audio_list(audio))
+    # The backends run in a scratch directory, the paths have to stay valid there
+    return [os.path.abspath(path) for path in files[:num_files]]
+
+
+async def run_backend(backend, files, behaviour, hedge_budget=None):
+    '''
+    Runs the process_audio of a cloud backend against the mock server.
+    Returns the numbers of the report table.
+    '''
+    module = importlib.import_module(CLOUD_BACKENDS[backend])
+    if hedge_budget is not None:
+        module.HEDGE_BUDGET = hedge_budget
+    behaviour.counts = dict.fromkeys(behaviour.counts, 0)
+    start = time.perf_counter()
+    await module.process_audio(files)
+    elapsed = time.perf_counter() - start
+
+    control = module.rate_control
+    latency = control.latency
+    return {
+        'backend': backend,
+        'seconds': elapsed,
+        'files/s': len(files) / elapsed,
+        'p50': latency.percentile(50),
+        'p95': latency.percentile(95),
+        'p99': latency.percentile(99),
+        'requests': control.requests,
+        'retries': control.retries,
+        'throttled': control.errors['throttled'],
+        'failed': control.errors['transient'],
+        'gave up': control.gave_up,
+        'hedges': control.hedges,
+        'in flight': control.limiter.in_flight_stats.mean(),
+        'concurrency': int(control.limiter.limit),
+    }
+
+
+async def load_test(backends, files, behaviour, port=PORT, http_port=HTTP_PORT, hedge_budget=None):
+    '''
+    Starts the mock server and runs every backend against it one after the other,
+    in a scratch directory so the real journals, outputs and response caches are
+    neither used nor touched.
+    '''
+    os.environ['SPEECH_EMULATOR_HOST'] = f'localhost:{port}'
+    os.environ['DEEPGRAM_API_URL'] = f'http://localhost:{http_port}/v1/listen'
+    servers = await start_servers(behaviour, port, http_port)
+    results = []
+    try:
+        for backend in backends:
+            os.chdir(tempfile.mkdtemp(prefix=f'load_test_{backend}_'))
+            results.append(await run_backend(backend, files, behaviour, hedge_budget))
+    finally:
+        await stop_servers(servers)
+    return results
+
+
+def print_results(results):
+    columns = list(results[0])
+    print()
+    print(''.join(f'{column:>12}' for column in columns))
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result[column]
+            if isinstance(value, float):
+                cells.append(f'{value:>12.2f}')
+            else:
+                cells.append(f'{"-" if value is None else value:>12}')
+        print(''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the cloud backends against the local mock ASR server.")
+    parser.add_argument("--backends", default=",".join(CLOUD_BACKENDS),
+                        help="comma separated list of: " + ", ".join(CLOUD_BACKENDS))
+    parser.add_argument("--audio", required=True, help="path to the audio directory or CSV file")
+    parser.add_argument("--num-files", type=int, default=NUM_FILES)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--http-port", type=int, default=HTTP_PORT)
+    parser.add_argument("--hedge-budget", type=float, default=None,
+                        help="share of extra requests for hedging, overrides HEDGE_BUDGET of the backends")
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    backends = [backend.strip() for backend in args.backends.split(",")]
+    unknown = [backend for backend in backends if backend not in CLOUD_BACKENDS]
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(unknown)}")
+
+    files = list_files(args.audio, args.num_files)
+    results = asyncio.run(load_test(backends, files, behaviour_from_args(args),
+                                    args.port, args.http_port, args.hedge_budget))
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
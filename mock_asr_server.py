@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import grpc
+from aiohttp import web
+from google.cloud import speech_v1, speech_v2
+
+
+PORT = 50051  # gRPC, for google_model, google_model_tel and chirp
+HTTP_PORT = 8080  # HTTP, for deepgram_model
+LATENCY_S = 0.5  # Median time a request takes, like a cloud recognizer on a short clip
+TRANSCRIPT = "dit is een test"
+RETRY_AFTER_S = 1  # Sent along with every 429
+PARTIAL_EVERY = 5  # Streaming: a partial hypothesis with one more word every N audio messages
+
+
+class MockBehaviour:
+    '''
+    How the stand-in server answers: the latency distribution, the share of
+    throttled (429 / RESOURCE_EXHAUSTED) and failed (503 / UNAVAILABLE) requests
+    and the canned transcripts.
+    latency is 'fixed', 'uniform' (between 0 and twice the median) or 'lognormal'
+    (a long tail, sigma sets how long).
+    '''
+
+    def __init__(self, latency=LATENCY_S, distribution='fixed', sigma=0.5,
+                 throttle_rate=0.0, error_rate=0.0, transcripts=None):
+        self.latency = latency
+        self.distribution = distribution
+        self.sigma = sigma
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.transcripts = transcripts or [TRANSCRIPT]
+        self.counts = {'ok': 0, 'throttled': 0, 'error': 0}
+
+    def delay(self):
+        if self.distribution == 'uniform':
+            return random.uniform(0, 2 * self.latency)
+        if self.distribution == 'lognormal':
+            return random.lognormvariate(0, self.sigma) * self.latency
+        return self.latency
+
+    def outcome(self):
+        '''
+        Returns 'throttled', 'error' or 'ok' for the next request.
+        '''
+        draw = random.random()
+        if draw < self.throttle_rate:
+            outcome = 'throttled'
+        elif draw < self.throttle_rate + self.error_rate:
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+        self.counts[outcome] += 1
+        return outcome
+
+    def transcript(self, audio):
+        # The same clip always gets the same transcript
+        digest = hashlib.blake2b(audio, digest_size=8).digest()
+        return self.transcripts[int.from_bytes(digest, 'little') % len(self.transcripts)]
+
+
+def load_transcripts(path):
+    '''
+    Reads canned transcripts from a filename|transcript file (like the ones in
+    ref_transcripts) or from a file with one transcript per line.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return [line.split('|', 1)[1] if '|' in line else line for line in lines]
+
+
+def recognize_handler(request_type, response_type, behaviour):
+    '''
+    Returns a gRPC Recognize handler for the Google Speech v1 or v2 request type.
+    '''
+    async def recognize(request_bytes, context):
+        request = request_type.deserialize(request_bytes)
+        await asyncio.sleep(behaviour.delay())
+        outcome = behaviour.outcome()
+        if outcome == 'throttled':
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Quota exceeded (mock)')
+        if outcome == 'error':
+            await context.abort(grpc.StatusCode.UNAVAILABLE, 'Service unavailable (mock)')
+        # v1 requests wrap the audio in a RecognitionAudio, v2 requests carry it directly
+        audio = request.audio.content if request_type is speech_v1.RecognizeRequest else request.content
+        text = behaviour.transcript(audio)
+        response = response_type(results=[{'alternatives': [{'transcript': text}]}])
+        return response_type.serialize(response)
+
+    return grpc.unary_unary_rpc_method_handler(recognize)
+
+
+def partial_words(text, messages):
+    return ' '.join(text.split()[:messages // PARTIAL_EVERY])
+
+
+def streaming_handler(behaviour):
+    '''
+    Returns a gRPC StreamingRecognize handler for Google Speech v1: partial results
+    while the audio comes in, the final result once the client stops sending.
+    '''
+    async def streaming_recognize(request_iterator, context):
+        text = None
+        messages = 0
+        async for request_bytes in request_iterator:
+            request = speech_v1.StreamingRecognizeRequest.deserialize(request_bytes)
+            if not request.audio_content:
+                continue
+            # The transcript of a stream follows from its first audio message
+            text = text or behaviour.transcript(request.audio_content)
+            messages += 1
+            if messages % PARTIAL_EVERY == 0:
+                yield speech_v1.StreamingRecognizeResponse.serialize(
+                    speech_v1.StreamingRecognizeResponse(results=[{
+                        'alternatives': [{'transcript': partial_words(text, messages)}],
+                        'is_final': False}]))
+        await asyncio.sleep(behaviour.delay())
+        behaviour.counts['ok'] += 1
+        yield speech_v1.StreamingRecognizeResponse.serialize(
+            speech_v1.StreamingRecognizeResponse(results=[{
+                'alternatives': [{'transcript': text or ''}], 'is_final': True}]))
+
+    return grpc.stream_stream_rpc_method_handler(streaming_recognize)
+
+
+def deepgram_live_handler(behaviour):
+    '''
+    Returns an aiohttp handler for Deepgram's live websocket on /v1/listen: interim
+    results while the audio comes in, the final result after a CloseStream message.
+    '''
+    async def listen_live(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        text = None
+        messages = 0
+        async for message in ws:
+            if message.type == web.WSMsgType.BINARY:
+                text = text or behaviour.transcript(message.data)
+                messages += 1
+                if messages % PARTIAL_EVERY == 0:
+                    await ws.send_json({'type': 'Results', 'is_final': False, 'channel': {
+                        'alternatives': [{'transcript': partial_words(text, messages)}]}})
+            elif message.type == web.WSMsgType.TEXT and json.loads(message.data).get('type') == 'CloseStream':
+                break
+        await asyncio.sleep(behaviour.delay())
+        behaviour.counts['ok'] += 1
+        await ws.send_json({'type': 'Results', 'is_final': True, 'channel': {
+            'alternatives': [{'transcript': text or ''}]}})
+        await ws.close()
+        return ws
+
+    return listen_live
+
+
+def deepgram_handler(behaviour):
+    '''
+    Returns an aiohttp handler for Deepgram's pre-recorded /v1/listen endpoint.
+    '''
+    async def listen(request):
+        audio = await request.read()
+        await asyncio.sleep(behaviour.delay())
+        outcome = behaviour.outcome()
+        if outcome == 'throttled':
+            return web.json_response({'err_code': 'TOO_MANY_REQUESTS'}, status=429,
+                                     headers={'Retry-After': str(RETRY_AFTER_S)})
+        if outcome == 'error':
+            return web.json_response({'err_code': 'SERVICE_UNAVAILABLE'}, status=503)
+        text = behaviour.transcript(audio)
+        return web.json_response({'results': {'channels': [
+            {'alternatives': [{'transcript': text, 'confidence': 1.0}]}]}})
+
+    return listen
+
+
+async def start_servers(behaviour, port=PORT, http_port=HTTP_PORT):
+    '''
+    Starts the gRPC and HTTP stand-ins on localhost, returns both so they can be stopped.
+    '''
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers([
+        grpc.method_handlers_generic_handler('google.cloud.speech.v1.Speech', {
+            'Recognize': recognize_handler(
+                speech_v1.RecognizeRequest, speech_v1.RecognizeResponse, behaviour),
+            'StreamingRecognize': streaming_handler(behaviour)}),
+        grpc.method_handlers_generic_handler('google.cloud.speech.v2.Speech', {
+            'Recognize': recognize_handler(
+                speech_v2.RecognizeRequest, speech_v2.RecognizeResponse, behaviour)}),
+    ])
+    server.add_insecure_port(f'localhost:{port}')
+    await server.start()
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/v1/listen', deepgram_handler(behaviour))
+    app.router.add_get('/v1/listen', deepgram_live_handler(behaviour))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', http_port).start()
+    return server, runner
+
+
+async def stop_servers(servers):
+    server, runner = servers
+    await server.stop(None)
+    await runner.cleanup()
+
+
+async def serve(behaviour, port=PORT, http_port=HTTP_PORT):
+    '''
+    Stand-in for the Google Speech v1 (google_model, google_model_tel) and v2 (chirp)
+    Recognize calls, v1 StreamingRecognize and for Deepgram's pre-recorded and live
+    APIs (streaming.py). Run the backends against it
+    with SPEECH_EMULATOR_HOST=localhost:<port> and
+    DEEPGRAM_API_URL=http://localhost:<http_port>/v1/listen.
+    '''
+    # The gRPC server stops when it is garbage collected, keep a reference while serving
+    servers = await start_servers(behaviour, port, http_port)
+    print(f'Mock ASR server listening on localhost:{port} (gRPC) '
+          f'and http://localhost:{http_port}/v1/listen')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_servers(servers)
+
+
+def add_behaviour_arguments(parser):
+    parser.add_argument("--latency", type=float, default=LATENCY_S,
+                        help="median seconds a request takes")
+    parser.add_argument("--distribution", choices=("fixed", "uniform", "lognormal"),
+                        default="fixed", help="distribution of the request latency")
+    parser.add_argument("--sigma", type=float, default=0.5,
+                        help="spread of the lognormal latency, higher means a longer tail")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of the requests answered with 429 / RESOURCE_EXHAUSTED")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of the requests answered with 503 / UNAVAILABLE")
+    parser.add_argument("--transcripts", default=None,
+                        help="file with the canned transcripts, for example ref_transcripts/transcripts_cgn_a.txt")
+
+
+def behaviour_from_args(args):
+    transcripts = load_transcripts(args.transcripts) if args.transcripts else None
+    return MockBehaviour(args.latency, args.distribution, args.sigma,
+                         args.throttle_rate, args.error_rate, transcripts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Google Speech and Deepgram APIs.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--http-port", type=int, default=HTTP_PORT)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(serve(behaviour_from_args(args), args.port, args.http_port))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,140 @@
-from pydub import AudioSegment
+import argparse
+import csv
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from pydub import AudioSegment
+from wav_io import is_mono_pcm, read_wav_header
+
+
+MANIFEST_PATH = './normalization_manifest.json'
+NORMALIZE_WORKERS = os.cpu_count() or 1
+SAVE_EVERY = 1000  # Write the manifest to disk every N checked files
+
+
+def list_wav_files(path):
+    '''
+    Returns the .wav paths of a directory or of the wav_filename column of a CSV file.
+    '''
+    if os.path.isdir(path):
+        return [os.path.join(path, filename) for filename in os.listdir(path)
+                if filename.endswith(".wav")]
+
+    # Assuming it's a CSV file, process accordingly
+    wav_files = []
+    with open(path, "r") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            file_path = row["wav_filename"]
+            if file_path.endswith(".wav"):
+                wav_files.append(file_path)
+            else:
+                print(f"'{file_path}' is not a WAV file, skipping.")
+    return wav_files
+
+
+def load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    # Write to a temporary file first so a crash never leaves a broken manifest
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def manifest_entry(file_path, sample_width):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns, sample_width]
 
 
-def convert_to_mono_and_export(path):
+def normalize_file(file_path, sample_width=2):
+    '''
+    Converts one file to mono (and to sample_width bytes per sample) in place.
+    The WAV header is checked first so files that already match are not rewritten.
+    Returns (file_path, converted).
+    '''
+    try:
+        if is_mono_pcm(read_wav_header(file_path), sample_width):
+            return file_path, False
+    except ValueError:
+        # Let pydub deal with headers we can't parse
+        pass
+
+    sound = AudioSegment.from_wav(file_path)
+
+    # Check if the audio is stereo
+    if sound.channels > 1:
+        # Convert stereo to mono
+        sound = sound.set_channels(1)
+
+    if sample_width is not None:
+        sound = sound.set_sample_width(sample_width)
+
+    # Export next to the original and swap, an interrupted run never leaves half a file
+    tmp_path = file_path + '.tmp'
+    sound.export(tmp_path, format="wav")
+    os.replace(tmp_path, file_path)
+    return file_path, True
+
+
+def convert_to_mono_and_export(path, sample_width=2, workers=NORMALIZE_WORKERS,
+                               manifest_path=MANIFEST_PATH):
     """
-    Convert stereo audio files to mono and export them as WAV files.
+    Convert stereo audio files to mono and export them as WAV files with 16-bit samples.
+    Files listed in the manifest with an unchanged size and mtime are skipped,
+    the rest is checked and converted across a pool of worker processes.
 
     Args:
-    - path (str): Path to the directory containing the audio files.
+    - path (str): Path to the directory or CSV file containing the audio files.
+    - sample_width (int): Bytes per sample to convert to, None keeps the sample width.
+    - workers (int): Number of worker processes.
+    - manifest_path (str): JSON file keeping track of the normalized files.
     """
-    # Iterate over each file in the directory
-    for filename in os.listdir(path):
-        if filename.endswith(".wav"):
-            file_path = os.path.join(path, filename)
-            sound = AudioSegment.from_wav(file_path)
-
-            # Check if the audio is stereo
-            if sound.channels > 1:
-                # Convert stereo to mono
-                sound = sound.set_channels(1)
-
-                # Export the mono audio as WAV
-                sound.export(file_path, format="wav")
-                print(f"Converted '{filename}' to mono and exported as WAV.")
-            else:
-                print(f"'{filename}' is already mono, skipping.")
+    manifest = load_manifest(manifest_path)
+
+    todo = []
+    num_unchanged = 0
+    for file_path in list_wav_files(path):
+        if not os.path.isfile(file_path):
+            print(f"'{file_path}' does not exist, skipping.")
+            continue
+        entry = manifest.get(os.path.abspath(file_path))
+        if entry is not None and entry == manifest_entry(file_path, sample_width):
+            num_unchanged += 1
+            continue
+        todo.append(file_path)
+
+    num_converted = 0
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(normalize_file, todo, [sample_width] * len(todo),
+                                   chunksize=max(1, len(todo) // (workers * 8)))
+            for done, (file_path, converted) in enumerate(results, 1):
+                manifest[os.path.abspath(file_path)] = manifest_entry(
+                    file_path, sample_width)
+                num_converted += converted
+                if done % SAVE_EVERY == 0:
+                    save_manifest(manifest, manifest_path)
+        save_manifest(manifest, manifest_path)
+
+    print(f"Normalization: {num_converted} converted, {len(todo) - num_converted} "
+          f"already normalized, {num_unchanged} unchanged since the last run.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="directory or CSV file with the audio files")
+    parser.add_argument("--sample-width", type=int, default=None,
+                        help="also convert to this many bytes per sample (2 = 16-bit)")
+    parser.add_argument("--workers", type=int, default=NORMALIZE_WORKERS)
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    convert_to_mono_and_export(
+        args.path, args.sample_width, args.workers, args.manifest)
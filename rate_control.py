@@ -0,0 +1,296 @@
+import asyncio
+import random
+import time
+from async_scheduler import DepthStats, LatencyStats
+
+
+BASE_DELAY = 1.0  # Seconds before the first retry, doubled every attempt
+MAX_DELAY = 60.0
+MAX_THROTTLED_RETRIES = 10  # 429s only mean "later", they get more retries than other errors
+MIN_CONCURRENCY = 1
+HEDGE_PERCENTILE = 95  # A request still running after this latency percentile gets a duplicate
+MIN_HEDGE_SAMPLES = 20  # Latencies needed before the percentile is trusted
+HEDGE_REFRESH = 50  # The hedge delay is recomputed every N new latencies
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# gRPC status names (Google) and HTTP status codes (Deepgram) of every class
+GRPC_CLASSES = {
+    'RESOURCE_EXHAUSTED': THROTTLED,
+    'UNAVAILABLE': TRANSIENT,
+    'DEADLINE_EXCEEDED': TRANSIENT,
+    'INTERNAL': TRANSIENT,
+    'ABORTED': TRANSIENT,
+    'UNKNOWN': TRANSIENT,
+}
+HTTP_THROTTLED = {429}
+HTTP_TRANSIENT = {408, 500, 502, 503, 504}
+
+
+def status_of(error):
+    '''
+    Returns the HTTP status code or gRPC status name of a client error, or None.
+    '''
+    # grpc.aio errors have a code() method returning a StatusCode
+    code = getattr(error, 'code', None)
+    if callable(code):
+        code = code()
+    grpc_status = getattr(error, 'grpc_status_code', None) or code
+    if hasattr(grpc_status, 'name'):
+        return grpc_status.name
+    for value in (getattr(error, 'status', None), getattr(error, 'status_code', None), code,
+                  getattr(getattr(error, 'response', None), 'status_code', None)):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def classify_error(error):
+    '''
+    Sorts an error of a cloud request into THROTTLED (slow down and retry),
+    TRANSIENT (retry) or PERMANENT (retrying gives the same answer).
+    '''
+    status = status_of(error)
+    if isinstance(status, str):
+        return GRPC_CLASSES.get(status, PERMANENT)
+    if status in HTTP_THROTTLED:
+        return THROTTLED
+    if status in HTTP_TRANSIENT:
+        return TRANSIENT
+    if status is not None:
+        return PERMANENT
+    # Missing files are OSErrors as well, but won't appear by retrying
+    if isinstance(error, (FileNotFoundError, PermissionError, IsADirectoryError)):
+        return PERMANENT
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def retry_after(error):
+    '''
+    Returns the delay in seconds the server asked for, or None.
+    Reads the Retry-After header of HTTP errors and the RetryInfo detail of Google errors.
+    '''
+    headers = getattr(error, 'headers', None)
+    if headers is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers:
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            pass
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+def backoff_delay(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    '''
+    Exponential backoff with full jitter: a random delay up to base * 2 ** attempt,
+    so clients that failed together don't all retry at the same moment.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    '''
+    Allows `rate` requests per second on average, with bursts of up to `burst`.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AimdLimiter:
+    '''
+    Concurrency limit that adapts to throttling: every limit successful requests
+    raise it by one (additive increase), a throttled request halves it
+    (multiplicative decrease). Requests that started before the last decrease
+    don't decrease it again, one burst of 429s counts once.
+    '''
+
+    def __init__(self, initial, minimum=MIN_CONCURRENCY, maximum=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.in_flight = 0
+        # Requests holding a slot, what the server really sees at once
+        self.in_flight_stats = DepthStats()
+        self.decreases = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.in_flight_stats.set(self.in_flight)
+        return time.monotonic()
+
+    async def release(self, started, throttled=False):
+        async with self.condition:
+            self.in_flight -= 1
+            self.in_flight_stats.set(self.in_flight)
+            if throttled:
+                if started >= self.last_decrease:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                    self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RateController:
+    '''
+    Runs the requests of a cloud backend: waits for the token bucket (when
+    requests_per_second is set) and a slot of the AIMD limiter, retries throttled
+    and transient errors with jittered exponential backoff or the delay the server
+    asked for, and raises permanent errors right away.
+    The latency of every successful request is kept for the report.
+    With a hedge_budget (0.05 allows 5% extra requests) a request that is slower than
+    HEDGE_PERCENTILE of the latencies so far is sent a second time, the first answer wins.
+    '''
+
+    def __init__(self, name, concurrency, max_concurrency=None, requests_per_second=None,
+                 max_retries=3, base_delay=BASE_DELAY, max_throttled_retries=MAX_THROTTLED_RETRIES,
+                 hedge_budget=None, hedge_percentile=HEDGE_PERCENTILE):
+        self.name = name
+        self.limiter = AimdLimiter(concurrency, maximum=max_concurrency)
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.max_throttled_retries = max_throttled_retries
+        self.base_delay = base_delay
+        self.requests = 0
+        self.errors = {THROTTLED: 0, TRANSIENT: 0, PERMANENT: 0}
+        self.retries = 0
+        self.gave_up = 0
+        self.latency = LatencyStats(name)
+        self.hedge_budget = hedge_budget
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = None
+        self.hedge_samples = 0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_allowed(self):
+        return bool(self.hedge_budget) and self.hedges < self.hedge_budget * self.calls
+
+    def current_hedge_delay(self):
+        '''
+        Returns the seconds after which a request gets a duplicate, or None when
+        hedging is off, the budget is used up or there are too few latencies yet.
+        '''
+        samples = len(self.latency.latencies)
+        if not self.hedge_allowed() or samples < MIN_HEDGE_SAMPLES:
+            return None
+        if self.hedge_delay is None or samples - self.hedge_samples >= HEDGE_REFRESH:
+            self.hedge_delay = self.latency.percentile(self.hedge_percentile)
+            self.hedge_samples = samples
+        return self.hedge_delay
+
+    async def hedged(self, request, args):
+        '''
+        Awaits request(*args). When it is still running after the hedge delay, the same
+        request is sent again and the first successful answer is returned, the other
+        request is cancelled. The duplicate doesn't take a slot of the limiter, the
+        budget keeps their number down.
+        '''
+        delay = self.current_hedge_delay()
+        if delay is None:
+            return await request(*args)
+        first = asyncio.ensure_future(request(*args))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Other requests may have used up the budget in the meantime
+            if done or not self.hedge_allowed():
+                return await first
+            self.hedges += 1
+            self.requests += 1
+            tasks.add(asyncio.ensure_future(request(*args)))
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                answered = [task for task in done if task.exception() is None]
+                if answered:
+                    if first not in answered:
+                        self.hedge_wins += 1
+                    return answered[0].result()
+            # Both failed, the error of the original goes to the retry logic
+            return first.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(self, request, *args):
+        '''
+        Returns await request(*args), retrying it as long as the error allows.
+        '''
+        failures = 0
+        throttles = 0
+        self.calls += 1
+        while True:
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            started = await self.limiter.acquire()
+            self.requests += 1
+            try:
+                result = await self.hedged(request, args)
+                self.latency.add(time.monotonic() - started)
+            except Exception as e:
+                kind = classify_error(e)
+                self.errors[kind] += 1
+                await self.limiter.release(started, throttled=kind == THROTTLED)
+                if kind == THROTTLED:
+                    throttles += 1
+                    attempt, limit = throttles, self.max_throttled_retries
+                else:
+                    failures += 1
+                    attempt, limit = failures, self.max_retries
+                if kind == PERMANENT or attempt > limit:
+                    self.gave_up += 1
+                    raise
+                delay = max(retry_after(e) or 0, backoff_delay(attempt - 1, self.base_delay))
+                print(f'{self.name}: {kind} {type(e).__name__}, retry {attempt}/{limit} '
+                      f'in {delay:.1f}s (concurrency {int(self.limiter.limit)})')
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+            await self.limiter.release(started)
+            return result
+
+    def report(self):
+        errors = ', '.join(f'{count} {kind}' for kind, count in self.errors.items() if count)
+        print(f'{self.name}: {self.requests} requests, {self.retries} retries, '
+              f'{self.gave_up} gave up{" (" + errors + ")" if errors else ""}; '
+              f'concurrency ended at {int(self.limiter.limit)} '
+              f'({self.limiter.in_flight_stats.mean():.1f} in flight on average, '
+              f'max {self.limiter.in_flight_stats.max}, {self.limiter.decreases} decreases)')
+        self.latency.report()
+        if self.hedge_budget:
+            print(f'{self.name} hedging: {self.hedges} duplicate requests '
+                  f'({100 * self.hedges / max(self.calls, 1):.1f}% extra, budget '
+                  f'{100 * self.hedge_budget:.0f}%), {self.hedge_wins} answered first'
+                  + (f', sent after {self.hedge_delay:.2f}s' if self.hedge_delay else ''))
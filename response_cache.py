@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from journal import stand_in_path
+
+
+CACHE_DIR = './response_cache'
+READ_CHUNK = 1024 ** 2
+
+
+def file_digest(path):
+    '''
+    blake2b hash of the content of a file, a renamed or copied clip still matches.
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    '''
+    On-disk cache of the raw responses of a cloud backend, keyed by the hash of
+    the audio and of the request config (model, language, options, ...).
+    A clip that was sent before with the same config is replayed from disk
+    instead of being uploaded and billed again.
+    dumps and loads convert a response to and from text.
+    Responses of a stand-in server (see journal.stand_in_path) are kept apart.
+    '''
+
+    def __init__(self, backend, config, dumps=json.dumps, loads=json.loads, cache_dir=CACHE_DIR,
+                 stand_in=None):
+        if stand_in:
+            config = {**config, 'stand_in': stand_in}
+            cache_dir = stand_in_path(cache_dir, stand_in)
+        self.backend = backend
+        self.config = json.dumps(config, sort_keys=True, default=str)
+        self.dumps = dumps
+        self.loads = loads
+        self.cache_dir = os.path.join(cache_dir, backend)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def path(self, file_path):
+        digest = hashlib.blake2b(self.config.encode(), digest_size=20)
+        digest.update(file_digest(file_path).encode())
+        return os.path.join(self.cache_dir, digest.hexdigest() + '.json')
+
+    async def fetch(self, file_path, request):
+        '''
+        Returns the cached response of this clip, or awaits request() and caches its response.
+        '''
+        path = self.path(file_path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = self.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            response = None
+        if response is not None:
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(file_path)
+            return response
+
+        self.misses += 1
+        response = await request()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.dumps(response))
+        os.replace(tmp_path, path)
+        return response
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            print(f'{self.backend} response cache: {self.hits}/{total} hits '
+                  f'({100 * self.hits / total:.1f}%), '
+                  f'{self.bytes_saved / 1024 ** 2:.1f} MB not uploaded')
@@ -1,9 +1,20 @@
 from transformers import SeamlessM4Tv2ForSpeechToText, AutoProcessor
+import numpy as np
 import torch
+from batching import BATCH_SECONDS, MAX_BATCH_BYTES, as_clip_stream
+from feature_cache import config_id
+from journal import open_journal
+from staged_pipeline import transcribe_stream
+from vad import split_on_silence
 
 processor = None
 model = None
 
+OUTPUT_FILE = './seamless.txt'
+TGT_LANG = "nld"
+# Rough peak memory per second of audio in a batch, used to keep a batch under max_batch_bytes
+BYTES_PER_SECOND = 8 * 1024 ** 2
+
 
 def load_seamless_model():
     global processor, model
@@ -18,23 +29,84 @@ def load_seamless_model():
     return model, processor
 
 
-def process_audio_transcriptions(processed_files, wav_files, model, processor):
+def cached_audio_inputs(clips, processor, feature_cache):
+    '''
+    Builds the model inputs of a batch from the feature cache.
+    Every clip is cached unpadded with its valid length, the batch is padded
+    with zeros and masked the same way the processor does it.
+    '''
+    def compute(clips):
+        entries = []
+        for clip in clips:
+            inputs = processor(audios=[clip], sampling_rate=16000, return_tensors="np")
+            entries.append({'input_features': inputs['input_features'][0],
+                            'length': np.array(inputs['attention_mask'][0].sum())})
+        return entries
+
+    features = feature_cache.get_many(
+        clips, config_id(processor.feature_extractor), compute)
+
+    max_frames = max(len(entry['input_features']) for entry in features)
+    num_bins = features[0]['input_features'].shape[-1]
+    input_features = np.zeros((len(features), max_frames, num_bins), dtype=np.float32)
+    attention_mask = np.zeros((len(features), max_frames), dtype=np.int32)
+    for i, entry in enumerate(features):
+        input_features[i, :len(entry['input_features'])] = entry['input_features']
+        attention_mask[i, :int(entry['length'])] = 1
+
+    return {'input_features': torch.from_numpy(input_features),
+            'attention_mask': torch.from_numpy(attention_mask)}
+
+
+def clip_bytes(num_samples):
+    return num_samples / 16000 * BYTES_PER_SECOND
+
+
+def journal_config(model, vad=False):
+    # Everything that changes the transcripts, other settings start a new journal
+    return {'model': model.name_or_path, 'tgt_lang': TGT_LANG, 'vad': vad}
+
+
+def process_audio_transcriptions(processed_files, wav_files, model, processor, feature_cache=None,
+                                 max_batch_seconds=None, max_batch_bytes=MAX_BATCH_BYTES,
+                                 vad=False):
+    '''
+    Transcribes the audio in batches and appends the results to seamless.txt.
+    processed_files is a list of audio tensors matching wav_files, or a lazy
+    stream of (filename, samples) pairs when wav_files is None.
+    With a feature_cache.FeatureCache the input features are read from disk
+    when the same clip was transcribed before.
+    Files already in the journal of this model and settings are skipped.
+    Batches hold up to max_batch_seconds of padded audio (None for BATCH_SECONDS), and
+    when max_batch_bytes is given their estimated memory use stays under it as well.
+    With vad=True silences are trimmed and clips are cut into segments at the pauses,
+    the segment transcripts are joined per file.
+    The next batch is loaded and the previous one written while the model works.
+    '''
+    if max_batch_seconds is None:
+        max_batch_seconds = BATCH_SECONDS
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
     model.to(device)
 
-    for i in range(0, len(processed_files), 20):
-        batch_processed_files = processed_files[i:i+20]
-        batch_filenames = wav_files[i:i+20]
-
-        print('Working on batch:', batch_filenames)
-        audio_inputs = processor(
-            audios=batch_processed_files, sampling_rate=16000, return_tensors="pt").to(device)
-        output_tokens = model.generate(**audio_inputs, tgt_lang="nld")
-        translated_texts = processor.batch_decode(
-            output_tokens, skip_special_tokens=True)
-
-        # Save the transcriptions to the output file after each batch
-        with open(f'./seamless.txt', 'a') as file:
-            for idx, translation in enumerate(translated_texts):
-                filename = batch_filenames[idx]
-                file.write(f"{filename}|{translation}\n")
+    journal = open_journal(OUTPUT_FILE, 'seamless', journal_config(model, vad))
+    clips = (clip for clip in as_clip_stream(processed_files, wav_files)
+             if not journal.is_done(clip[0]))
+
+    def transcribe(batch_processed_files):
+        if feature_cache is not None:
+            audio_inputs = cached_audio_inputs(
+                batch_processed_files, processor, feature_cache)
+            audio_inputs = {name: value.to(device)
+                            for name, value in audio_inputs.items()}
+        else:
+            audio_inputs = processor(
+                audios=batch_processed_files, sampling_rate=16000, return_tensors="pt").to(device)
+        output_tokens = model.generate(**audio_inputs, tgt_lang=TGT_LANG)
+        return processor.batch_decode(output_tokens, skip_special_tokens=True)
+
+    # Batches of clips with a similar length, sized by the audio they hold
+    transcribe_stream(clips, transcribe, journal, split=split_on_silence if vad else None,
+                      max_seconds=max_batch_seconds, max_bytes=max_batch_bytes,
+                      clip_bytes=clip_bytes)
+    if feature_cache is not None:
+        feature_cache.report()
@@ -0,0 +1,229 @@
+import argparse
+import heapq
+import multiprocessing
+import os
+import time
+from automate import iter_audio_files, list_audio_files, read_audio_list
+from batching import MAX_BATCH_BYTES
+from feature_cache import FeatureCache
+from journal import config_hash, journal_path, open_journal
+from mono_audio import convert_to_mono_and_export
+from wav_io import read_wav_header
+
+
+# Output of every worker per backend and config, merged into the usual output file and removed
+SHARD_DIR = './shards'
+NUM_WORKERS = 4
+
+
+def audio_seconds(path):
+    '''
+    Duration of a .wav file from its header, 0 when the header can't be read.
+    '''
+    try:
+        header = read_wav_header(path)
+    except (OSError, ValueError):
+        return 0.0
+    bytes_per_second = header.sample_rate * header.channels * header.bits_per_sample // 8
+    return header.data_size / bytes_per_second if bytes_per_second else 0.0
+
+
+def split_shards(paths, durations, num_shards):
+    '''
+    Splits the files over num_shards shards with about the same amount of audio:
+    the longest files go first, each to the shard with the least audio so far.
+    Every shard keeps the input order of its files.
+    '''
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0.0, shard) for shard in range(num_shards)]
+    for i in sorted(range(len(paths)), key=lambda i: -durations[i]):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(i)
+        heapq.heappush(heap, (total + durations[i], shard))
+    return [[paths[i] for i in sorted(shard)] for shard in shards]
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def worker_cores(index, threads):
+    '''
+    The cores worker `index` is pinned to, threads consecutive cores of the ones
+    this process may use. Empty when there are not enough cores left to pin to.
+    '''
+    return available_cores()[index * threads:(index + 1) * threads]
+
+
+def load_backend(backend, batch_seconds, max_batch_bytes, vad, whisper_options, feature_cache):
+    '''
+    Loads a local model once in the coordinator.
+    Returns the model module, its journal config and a function transcribing a stream of clips.
+    '''
+    cache = FeatureCache() if feature_cache else None
+    if backend == 'seamless':
+        import seamless_model as module
+        model, processor = module.load_seamless_model()
+        return module, module.journal_config(model, vad), lambda stream: (
+            module.process_audio_transcriptions(
+                stream, None, model, processor, cache, batch_seconds,
+                max_batch_bytes, vad))
+
+    import whisper_model as module
+    pipe = module.load_whisper_model(**whisper_options)
+    return module, module.journal_config(pipe, vad), lambda stream: (
+        module.process_audio_transcriptions_with_pipe(
+            stream, None, pipe, cache, batch_seconds, max_batch_bytes, vad))
+
+
+def shard_prefix(backend, config):
+    # Shards of another model or other options are never merged into this output
+    return f'{backend}-{config_hash(config)}-'
+
+
+def shard_output(backend, config, index):
+    return os.path.join(SHARD_DIR, f'{shard_prefix(backend, config)}{index}.txt')
+
+
+def run_shard(index, paths, module, backend, config, transcribe, threads):
+    '''
+    THIS IS A HELPER FUNCTION FOR run_sharded
+    runs in a forked worker process: pins the worker to its own cores and transcribes
+    its shard into its own output file.
+    '''
+    import torch
+    cores = worker_cores(index, threads)
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+
+    module.OUTPUT_FILE = shard_output(backend, config, index)
+    # Decoding runs on a thread of the worker, the cores are already taken by the other workers
+    transcribe(iter_audio_files(paths, workers=1))
+
+
+def merge_shards(journal, paths, backend, config):
+    '''
+    Appends the transcripts of the shard output files of this backend and config to
+    the usual output file in input order, through the journal so a file is never
+    written twice. A shard whose files are all in the journal is removed, with the
+    journal of its worker. Returns the number of files merged.
+    '''
+    prefix = shard_prefix(backend, config)
+    shards = {}
+    if os.path.isdir(SHARD_DIR):
+        for name in os.listdir(SHARD_DIR):
+            if name.startswith(prefix) and name.endswith('.txt'):
+                shard = shards[os.path.join(SHARD_DIR, name)] = {}
+                with open(os.path.join(SHARD_DIR, name), 'r') as f:
+                    for line in f:
+                        if '|' in line:
+                            filename, text = line.rstrip('\n').split('|', 1)
+                            shard[filename] = text
+    transcripts = {filename: text for shard in shards.values() for filename, text in shard.items()}
+
+    filenames = [os.path.basename(path) for path in paths]
+    merged = [(filename, transcripts[filename]) for filename in filenames
+              if filename in transcripts and not journal.is_done(filename)]
+    journal.write_many(merged)
+
+    # Shards with files of another audio list stay until a run over that list merges them
+    for path, shard in shards.items():
+        if all(journal.is_done(filename) for filename in shard):
+            os.remove(path)
+            worker_journal = journal_path(path, backend, config)
+            if os.path.exists(worker_journal):
+                os.remove(worker_journal)
+    return len(merged)
+
+
+def run_sharded(backend, audio_dir, num_workers=NUM_WORKERS, threads=None,
+                batch_seconds=None, max_batch_bytes=MAX_BATCH_BYTES, vad=False,
+                whisper_options=None, feature_cache=False):
+    '''
+    Data-parallel transcription with a local model on one CPU box.
+    The model is loaded once and the coordinator forks num_workers worker processes,
+    which share the weights copy-on-write, so extra workers cost activations and
+    batches rather than a full model copy. Every worker gets an equal share of the
+    audio and its own cores and torch threads, and writes a shard output in SHARD_DIR.
+    The shards are merged into the usual output file in input order.
+    '''
+    # Forked workers can't use a CUDA context of the parent, the sharded mode is CPU only
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import torch
+
+    convert_to_mono_and_export(audio_dir)
+    paths = list_audio_files(read_audio_list(audio_dir))
+
+    if threads is None:
+        threads = max(1, len(available_cores()) // num_workers)
+    # Load with one thread, a forked child can't use the OpenMP threads of its parent
+    torch.set_num_threads(1)
+    module, config, transcribe = load_backend(
+        backend, batch_seconds, max_batch_bytes, vad, whisper_options or {}, feature_cache)
+
+    journal = open_journal(module.OUTPUT_FILE, backend, config)
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    # Transcripts of a previous run that stopped before merging
+    merge_shards(journal, paths, backend, config)
+    paths = journal.pending(paths)
+    if not paths:
+        print(f'{backend}: every file is already transcribed')
+        return
+
+    durations = [audio_seconds(path) for path in paths]
+    shards = [shard for shard in split_shards(paths, durations, num_workers) if shard]
+    print(f'{backend}: {len(paths)} files ({sum(durations) / 3600:.1f}h of audio) over '
+          f'{len(shards)} workers with {threads} threads each')
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_shard,
+                               args=(index, shard, module, backend, config, transcribe, threads))
+               for index, shard in enumerate(shards)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    merged = merge_shards(journal, paths, backend, config)
+    failed = [index for index, worker in enumerate(workers) if worker.exitcode != 0]
+    print(f'{backend}: {merged}/{len(paths)} files in {elapsed:.1f}s, '
+          f'{merged / elapsed:.2f} files/s, {sum(durations) / elapsed:.1f}s of audio per second')
+    if failed:
+        print(f'Workers {failed} failed, run again to transcribe the files they missed')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcribe audio with Whisper or Seamless on several worker processes.")
+    parser.add_argument("--backend", choices=("whisper", "seamless"), default="whisper")
+    parser.add_argument("--audio", required=True,
+                        help="path to the audio directory or CSV file")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS,
+                        help="number of worker processes, each transcribing a shard of the audio")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per worker (default: the cores divided over the workers)")
+    parser.add_argument("--batch-seconds", type=float, default=None,
+                        help="seconds of padded audio per batch (default: the budget of the model)")
+    parser.add_argument("--max-batch-gb", type=float, default=MAX_BATCH_BYTES / 1024 ** 3)
+    parser.add_argument("--vad", action="store_true")
+    parser.add_argument("--feature-cache", action="store_true",
+                        help="cache the input features on disk, for repeated runs over the same audio")
+    parser.add_argument("--quantize", action="store_true",
+                        help="run Whisper with int8 linear layers")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the Whisper encoder in every worker")
+    args = parser.parse_args()
+
+    max_batch_bytes = args.max_batch_gb * 1024 ** 3
+    run_sharded(args.backend, args.audio, args.workers, args.threads, args.batch_seconds,
+                max_batch_bytes, args.vad,
+                {'quantize': args.quantize, 'compile': args.compile}, args.feature_cache)
+
+
+if __name__ == "__main__":
+    main()
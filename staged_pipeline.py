@@ -0,0 +1,227 @@
+import queue
+import threading
+import time
+from batching import BatchStats, bucket_batches, join_segments
+from wav_io import BatchBuffer
+
+
+QUEUE_SIZE = 2  # Batches waiting between two stages
+
+_done = object()
+
+
+class StageStats:
+    '''
+    Time a stage spent working and waiting on the stages around it.
+    A stage that mostly waits for input is fed too slowly, the stage with the
+    most busy time is the bottleneck.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.wait_input = 0.0
+        self.wait_output = 0.0
+        self.items = 0
+
+
+def report_stages(stages):
+    print(f'\n{"stage":<8}{"items":>7}{"busy":>9}{"wait in":>10}{"wait out":>10}')
+    for stage in stages:
+        print(f'{stage.name:<8}{stage.items:>7}{stage.busy:>8.1f}s'
+              f'{stage.wait_input:>9.1f}s{stage.wait_output:>9.1f}s')
+    bottleneck = max(stages, key=lambda stage: stage.busy)
+    print(f'Bottleneck: {bottleneck.name}')
+
+
+def _put(q, item, stop, stats):
+    start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    finally:
+        stats.wait_output += time.perf_counter() - start
+
+
+def _get(q, stop, stats):
+    '''
+    Returns the next item of the queue. Items already queued are still returned after
+    stop is set, an empty queue then gives _done, so no stage waits for a stage that quit.
+    '''
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _done
+    finally:
+        stats.wait_input += time.perf_counter() - start
+
+
+def run_stages(source, process, sink, names=('load', 'infer', 'write'), queue_size=QUEUE_SIZE):
+    '''
+    Runs three stages at the same time, connected by bounded queues:
+    items are pulled from the source iterator on a thread, process(item) runs on the
+    calling thread and sink(item, result) runs on another thread.
+    So the next batch is loaded and the previous one written while the current one
+    is being processed. Returns the StageStats of the three stages.
+    '''
+    stats = [StageStats(name) for name in names]
+    load_stats, process_stats, sink_stats = stats
+    inputs = queue.Queue(maxsize=queue_size)
+    outputs = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    sink_error = []
+
+    def load():
+        try:
+            iterator = iter(source)
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, _done)
+                load_stats.busy += time.perf_counter() - start
+                if item is _done:
+                    break
+                load_stats.items += 1
+                if not _put(inputs, item, stop, load_stats):
+                    return
+        except Exception as e:
+            _put(inputs, e, stop, load_stats)
+            return
+        _put(inputs, _done, stop, load_stats)
+
+    def write():
+        while True:
+            item = _get(outputs, stop, sink_stats)
+            if item is _done:
+                return
+            start = time.perf_counter()
+            try:
+                sink(*item)
+            except Exception as e:
+                sink_error.append(e)
+                stop.set()
+                return
+            finally:
+                sink_stats.busy += time.perf_counter() - start
+                sink_stats.items += 1
+
+    loader = threading.Thread(target=load, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    loader.start()
+    writer.start()
+    try:
+        while True:
+            item = _get(inputs, stop, process_stats)
+            # The write stage failed, its error is raised below
+            if item is _done or stop.is_set():
+                break
+            if isinstance(item, Exception):
+                raise item
+            start = time.perf_counter()
+            result = process(item)
+            process_stats.busy += time.perf_counter() - start
+            process_stats.items += 1
+            if not _put(outputs, (item, result), stop, process_stats):
+                break
+    finally:
+        if not stop.is_set():
+            _put(outputs, _done, stop, process_stats)
+        stop.set()
+        loader.join()
+        writer.join()
+    if sink_error:
+        raise sink_error[0]
+    return stats
+
+
+class Window:
+    '''
+    The segments of one bucketing window and their transcripts. A clip is journaled
+    as soon as its last segment is done, the output file gets the clips of the
+    window in the original order once every batch of the window is done.
+    '''
+
+    def __init__(self, clips, segments, num_batches):
+        self.clips = clips
+        self.segments = segments
+        self.transcripts = [None] * len(segments)
+        self.segments_left = [0] * len(clips)
+        for i, _ in segments:
+            self.segments_left[i] += 1
+        # A window without speech still passes through once to be written
+        self.remaining = max(num_batches, 1)
+
+    def add(self, indices, texts):
+        '''
+        Stores the transcripts of a batch, returns the clips it finished.
+        '''
+        finished = []
+        for i, text in zip(indices, texts):
+            self.transcripts[i] = text
+            clip = self.segments[i][0]
+            self.segments_left[clip] -= 1
+            if self.segments_left[clip] == 0:
+                finished.append(clip)
+        return finished
+
+
+def transcribe_stream(clips, transcribe, journal, split=None, queue_size=QUEUE_SIZE,
+                      **budget):
+    '''
+    Shared driver of the local models. The clips are bucketed into batches
+    (see batching.bucket_batches with the budget arguments), the samples of each
+    batch are converted on the load thread, transcribe(batch_data) returns a
+    transcript or None per clip. On the write thread every batch is journaled
+    right away, so a crash loses at most the batches in flight, and the output
+    file is written per window in the original order.
+    '''
+    # Every batch in flight needs its own buffer: one being filled, the ones
+    # waiting in the queue and the one being transcribed
+    buffers = [BatchBuffer() for _ in range(queue_size + 2)]
+    batch_stats = BatchStats()
+
+    def load():
+        num_batches = 0
+        for clips_window, segments, batches in bucket_batches(clips, split=split, **budget):
+            window = Window(clips_window, segments, len(batches))
+            for indices in batches or [[]]:
+                buffer = buffers[num_batches % len(buffers)]
+                num_batches += 1
+                # Convert the int16 memory maps or torch.Tensor objects to float32 NumPy views
+                batch_data = buffer.fill([segments[i][1] for i in indices])
+                yield window, indices, batch_data
+
+    def process(item):
+        window, indices, batch_data = item
+        if not indices:
+            return []
+        print('Working on batch:', [window.clips[window.segments[i][0]][0] for i in indices])
+        start = time.perf_counter()
+        texts = transcribe(batch_data)
+        batch_stats.add([len(clip) for clip in batch_data], time.perf_counter() - start)
+        return texts
+
+    def write(item, texts):
+        window, indices, _ = item
+        finished = window.add(indices, texts)
+        journal.record_many(join_segments(window.clips, window.segments, window.transcripts,
+                                          finished))
+        window.remaining -= 1
+        if window.remaining == 0:
+            # Clips without speech have no segments, they are recorded with the window
+            transcripts = join_segments(window.clips, window.segments, window.transcripts)
+            journal.record_many(transcripts)
+            # Save the transcriptions to the output file in the original order
+            journal.write_output([filename for filename, _ in transcripts])
+
+    stages = run_stages(load(), process, write, queue_size=queue_size)
+    batch_stats.report()
+    report_stages(stages)
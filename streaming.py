@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from math import gcd
+import numpy as np
+from scipy.signal import resample_poly
+from async_scheduler import LatencyStats, run_sliding_window
+from automate import list_audio_files, read_audio_list
+from journal import open_journal
+from wav_io import read_wav_mmap
+
+
+FRAME_MS = 100  # Audio per message, a microphone delivers it at this pace
+STREAMS = 1  # Clips streamed at the same time
+OUTPUT_FILE = './streaming_{}.txt'
+WHISPER_STEP_S = 1.0  # Whisper decodes the audio received so far after every second of new audio
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_WINDOW_S = 30  # A full window is committed and decoding goes on with a new one
+
+
+class Hypotheses:
+    '''
+    Partial and final hypotheses of one streamed clip and when they arrived.
+    first token latency: from the start of the audio to the first hypothesis with text.
+    finalization latency: from the end of the audio to the last final hypothesis.
+    '''
+
+    def __init__(self, name, show_partials=False):
+        self.name = name
+        self.show_partials = show_partials
+        self.started = time.monotonic()
+        self.audio_end = None
+        self.first_token = None
+        self.finalized = None
+        self.finals = []
+
+    def partial(self, text):
+        if text.strip() and self.first_token is None:
+            self.first_token = time.monotonic()
+        if self.show_partials:
+            print(f'{self.name} ... {text}')
+
+    def final(self, text):
+        if text.strip() and self.first_token is None:
+            self.first_token = time.monotonic()
+        self.finalized = time.monotonic()
+        self.finals.append(text.strip())
+        if self.show_partials:
+            print(f'{self.name} final: {text}')
+
+    @property
+    def transcript(self):
+        return ' '.join(text for text in self.finals if text)
+
+    def first_token_latency(self):
+        return None if self.first_token is None else self.first_token - self.started
+
+    def finalization_latency(self):
+        if self.finalized is None or self.audio_end is None:
+            return None
+        return max(0.0, self.finalized - self.audio_end)
+
+
+async def replay_frames(samples, sample_rate, hypotheses, frame_ms=FRAME_MS):
+    '''
+    Yields the samples as 16-bit PCM frames of frame_ms, each one only once the
+    audio in it could have been recorded, like a live microphone.
+    '''
+    frame = max(1, sample_rate * frame_ms // 1000)
+    hypotheses.started = time.monotonic()
+    for offset in range(0, len(samples), frame):
+        chunk = samples[offset:offset + frame]
+        delay = hypotheses.started + (offset + len(chunk)) / sample_rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield np.asarray(chunk, dtype='<i2').tobytes()
+    hypotheses.audio_end = time.monotonic()
+
+
+async def stream_google(frames, sample_rate, hypotheses):
+    '''
+    Streams the frames to Google's StreamingRecognize with interim results,
+    using the model and language of google_model.
+    '''
+    from google.cloud import speech
+    from google_clients import get_client
+    from google_model import RECOGNITION_CONFIG
+
+    config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=sample_rate, **RECOGNITION_CONFIG),
+        interim_results=True)
+
+    async def requests():
+        yield speech.StreamingRecognizeRequest(streaming_config=config)
+        async for frame in frames:
+            yield speech.StreamingRecognizeRequest(audio_content=frame)
+
+    responses = await get_client('v1').streaming_recognize(requests=requests())
+    async for response in responses:
+        for result in response.results:
+            text = result.alternatives[0].transcript if result.alternatives else ''
+            if result.is_final:
+                hypotheses.final(text)
+            else:
+                hypotheses.partial(text)
+
+
+async def stream_deepgram(frames, sample_rate, hypotheses):
+    '''
+    Streams the frames over Deepgram's live websocket with interim results,
+    using the options of deepgram_model.
+    '''
+    import aiohttp
+    import deepgram_model
+
+    params = {name: str(value).lower() if isinstance(value, bool) else value
+              for name, value in deepgram_model.OPTIONS.items()}
+    params.update(encoding='linear16', sample_rate=sample_rate, channels=1,
+                  interim_results='true')
+    url = deepgram_model.DEEPGRAM_API_URL.replace('https://', 'wss://').replace('http://', 'ws://')
+
+    async with session.ws_connect(url, params=params) as ws:
+        async def send():
+            async for frame in frames:
+                await ws.send_bytes(frame)
+            # Deepgram sends the last final results and closes the socket
+            await ws.send_str(json.dumps({'type': 'CloseStream'}))
+
+        sender = asyncio.ensure_future(send())
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                result = json.loads(message.data)
+                if result.get('type') != 'Results':
+                    continue
+                text = result['channel']['alternatives'][0]['transcript']
+                if result.get('is_final'):
+                    hypotheses.final(text)
+                else:
+                    hypotheses.partial(text)
+            await sender
+        finally:
+            sender.cancel()
+
+
+def decode_whisper(samples, sample_rate):
+    '''
+    Transcribes int16 samples with the Whisper pipe of whisper_model.
+    '''
+    import whisper_model
+
+    # Float at the int16 scale, the same input the batch path gives the pipe
+    audio = samples.astype(np.float32)
+    if sample_rate != WHISPER_SAMPLE_RATE:
+        divisor = gcd(sample_rate, WHISPER_SAMPLE_RATE)
+        audio = resample_poly(audio, WHISPER_SAMPLE_RATE // divisor, sample_rate // divisor)
+    result = whisper_pipe(audio, generate_kwargs=whisper_model.generate_kwargs())
+    return result['text'].strip()
+
+
+async def stream_whisper(frames, sample_rate, hypotheses):
+    '''
+    Incremental chunked decoding with local Whisper: after every WHISPER_STEP_S of
+    new audio the current window is decoded again, that is the partial hypothesis.
+    When a decode is still running new audio is only collected, so a slow model
+    falls behind in partials and not in audio. A window of WHISPER_WINDOW_S is
+    committed as a final hypothesis and the next window starts empty.
+    '''
+    step = int(WHISPER_STEP_S * sample_rate)
+    window_size = WHISPER_WINDOW_S * sample_rate
+    window = np.zeros(0, dtype=np.int16)
+    decoded = 0
+    decoding = None
+
+    async for frame in frames:
+        window = np.concatenate([window, np.frombuffer(frame, dtype='<i2')])
+        if decoding is not None and decoding.done():
+            hypotheses.partial(decoding.result())
+            decoding = None
+        if len(window) >= window_size:
+            if decoding is not None:
+                await decoding
+                decoding = None
+            hypotheses.final(await asyncio.to_thread(decode_whisper, window[:window_size], sample_rate))
+            window = window[window_size:]
+            decoded = 0
+        elif decoding is None and len(window) - decoded >= step:
+            decoding = asyncio.ensure_future(asyncio.to_thread(decode_whisper, window, sample_rate))
+            decoded = len(window)
+
+    if decoding is not None and decoded == len(window):
+        # The running decode already has all the audio, it is the final hypothesis
+        hypotheses.final(await decoding)
+    elif len(window):
+        if decoding is not None:
+            hypotheses.partial(await decoding)
+        hypotheses.final(await asyncio.to_thread(decode_whisper, window, sample_rate))
+
+
+STREAMERS = {
+    'google': stream_google,
+    'deepgram': stream_deepgram,
+    'whisper': stream_whisper,
+}
+
+
+async def stream_file(file_path):
+    samples, sample_rate = read_wav_mmap(file_path)
+    name = os.path.basename(file_path)
+    hypotheses = Hypotheses(name, show_partials)
+    try:
+        await STREAMERS[backend](replay_frames(samples, sample_rate, hypotheses, frame_ms),
+                                 sample_rate, hypotheses)
+    except Exception as e:
+        print(f'Failed to stream {file_path} due to {type(e).__name__}: {e}. Moving to next file.')
+        return
+
+    if hypotheses.first_token_latency() is not None:
+        first_token.add(hypotheses.first_token_latency())
+    if hypotheses.finalization_latency() is not None:
+        finalization.add(hypotheses.finalization_latency())
+    print(f'Transcript for {file_path}: {hypotheses.transcript} '
+          f'(first token {hypotheses.first_token_latency() or 0:.2f}s, '
+          f'final {hypotheses.finalization_latency() or 0:.2f}s after the audio)')
+    journal.write(name, hypotheses.transcript)
+
+
+async def stream_files(files, streams):
+    global session
+    if backend == 'deepgram':
+        import aiohttp
+        import deepgram_model
+        async with aiohttp.ClientSession(
+                headers={'Authorization': f'Token {deepgram_model.DEEPGRAM_API_KEY}'}) as session:
+            await run_sliding_window(files, stream_file, streams, f'{backend} streaming')
+    else:
+        await run_sliding_window(files, stream_file, streams, f'{backend} streaming')
+
+
+def process_audio(data, streaming_backend, streams=STREAMS, frame=FRAME_MS, partials=False):
+    '''
+    Replays the clips in real time to a streaming recognizer and writes the final
+    transcripts to streaming_<backend>.txt. Reports the first token and
+    finalization latency over all clips.
+    '''
+    global backend, frame_ms, show_partials, journal, first_token, finalization, whisper_pipe
+    backend = streaming_backend
+    frame_ms = frame
+    show_partials = partials
+    if backend == 'whisper':
+        import whisper_model
+        whisper_pipe = whisper_model.load_whisper_model()
+
+    stand_in = None
+    if backend == 'google':
+        from google_clients import emulator_host
+        stand_in = emulator_host()
+    elif backend == 'deepgram':
+        import deepgram_model
+        stand_in = deepgram_model.stand_in()
+    journal = open_journal(OUTPUT_FILE.format(backend), f'streaming_{backend}',
+                           {'frame_ms': frame_ms}, stand_in)
+    first_token = LatencyStats(f'{backend} first token')
+    finalization = LatencyStats(f'{backend} finalization')
+
+    files = journal.pending(list_audio_files(data))
+    asyncio.run(stream_files(files, streams))
+    first_token.report()
+    finalization.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Real-time streaming transcription with first token and finalization latency.")
+    parser.add_argument("--backend", choices=list(STREAMERS), required=True)
+    parser.add_argument("--audio", required=True, help="path to the audio directory or CSV file")
+    parser.add_argument("--streams", type=int, default=STREAMS, help="clips streamed at the same time")
+    parser.add_argument("--frame-ms", type=int, default=FRAME_MS, help="milliseconds of audio per message")
+    parser.add_argument("--partials", action="store_true", help="print the partial hypotheses")
+    args = parser.parse_args()
+    process_audio(read_audio_list(args.audio), args.backend, args.streams, args.frame_ms, args.partials)
+
+
+if __name__ == "__main__":
+    main()
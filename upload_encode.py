@@ -0,0 +1,89 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import gcd
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+
+ENCODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+
+def encode_file(path, format='flac', sample_rate=None):
+    '''
+    Reads a .wav file and returns it as 16-bit FLAC or WAV bytes, resampled to
+    sample_rate when given (8 kHz for the telephony model).
+    FLAC is lossless, the recognizer gets the same samples in about half the bytes.
+    '''
+    data, rate = sf.read(path, dtype='int16')
+    if sample_rate and rate != sample_rate:
+        divisor = gcd(rate, sample_rate)
+        resampled = resample_poly(data.astype(np.float32), sample_rate // divisor,
+                                  rate // divisor, axis=0)
+        data = np.clip(np.round(resampled), -32768, 32767).astype(np.int16)
+        rate = sample_rate
+
+    buffer = io.BytesIO()
+    sf.write(buffer, data, rate, format=format.upper(), subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def timed_encode_file(path, format, sample_rate):
+    # Runs in a worker, the time doesn't include waiting for a free worker
+    start = time.perf_counter()
+    content = encode_file(path, format, sample_rate)
+    return content, time.perf_counter() - start
+
+
+class UploadEncoder:
+    '''
+    Optional encode stage of the cloud backends: converts every clip to FLAC and/or
+    resamples it on a pool of worker processes before it is uploaded.
+    Without a format or sample rate the files are sent as they are.
+    '''
+
+    def __init__(self, name, format=None, sample_rate=None, workers=ENCODE_WORKERS):
+        self.name = name
+        self.format = format or ('wav' if sample_rate else None)
+        self.sample_rate = sample_rate
+        self.executor = None
+        if self.format:
+            # Forking a process with open gRPC channels isn't safe, the workers start fresh
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.files = 0
+        self.original_bytes = 0
+        self.upload_bytes = 0
+        self.encode_time = 0.0
+
+    async def read(self, path):
+        '''
+        Returns the bytes to upload for this clip.
+        '''
+        if self.executor is None:
+            with open(path, 'rb') as f:
+                content = f.read()
+        else:
+            content, seconds = await asyncio.get_running_loop().run_in_executor(
+                self.executor, timed_encode_file, path, self.format, self.sample_rate)
+            self.encode_time += seconds
+        self.files += 1
+        self.original_bytes += os.path.getsize(path)
+        self.upload_bytes += len(content)
+        return content
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def report(self):
+        if self.executor is None or not self.files:
+            return
+        saved = self.original_bytes - self.upload_bytes
+        print(f'{self.name} upload: {self.upload_bytes / 1024 ** 2:.1f} MB instead of '
+              f'{self.original_bytes / 1024 ** 2:.1f} MB ({100 * saved / self.original_bytes:.1f}% saved), '
+              f'encoding took {1000 * self.encode_time / self.files:.0f} ms of worker time per file')
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+SAMPLE_RATE = 16000
+FRAME_S = 0.03
+MIN_SILENCE_S = 0.3  # Shorter pauses stay inside the speech
+MIN_SPEECH_S = 0.2  # Shorter bursts are treated as noise
+PADDING_S = 0.2  # Kept around every speech region so word edges aren't cut
+MAX_SEGMENT_S = 30  # Whisper decodes 30 seconds at a time
+SPLIT_SEARCH_S = 5  # Too long regions are cut at the quietest frame of their last seconds
+MIN_MARGIN_DB = 6
+SPEECH_RATIO = 0.3
+MIN_RANGE_DB = 12  # Flatter clips are all speech or all silence
+SILENCE_DBFS = -50  # Frames below this level are never speech
+FULL_SCALE_DB = 20 * np.log10(32768)  # The samples use the int16 scale
+
+
+def frame_energy_db(samples, frame_len):
+    '''
+    Returns the energy of every frame in dB relative to int16 full scale.
+    '''
+    num_frames = len(samples) // frame_len
+    frames = np.asarray(samples[:num_frames * frame_len], dtype=np.float32)
+    frames = frames.reshape(num_frames, frame_len)
+    return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10) - FULL_SCALE_DB
+
+
+def speech_regions(samples, sample_rate=SAMPLE_RATE):
+    '''
+    Energy based voice activity detection.
+    A frame is speech when it is louder than the noise floor (10th percentile of the
+    frame energies) by at least MIN_MARGIN_DB and SPEECH_RATIO of the dynamic range,
+    and louder than SILENCE_DBFS. Clips with hardly any dynamic range are judged on
+    SILENCE_DBFS alone. Returns the speech regions as (start, end) sample indices, padded and with
+    short pauses merged. Regions whose padding overlaps are merged too, so no sample is in
+    two regions.
+    '''
+    frame_len = int(FRAME_S * sample_rate)
+    energy = frame_energy_db(samples, frame_len)
+    if len(energy) == 0:
+        return []
+
+    noise_floor = np.percentile(energy, 10)
+    dynamic_range = energy.max() - noise_floor
+    threshold = SILENCE_DBFS
+    if dynamic_range >= MIN_RANGE_DB:
+        threshold = max(threshold, noise_floor + max(MIN_MARGIN_DB, SPEECH_RATIO * dynamic_range))
+    speech = energy > threshold
+
+    # Find the runs of speech frames
+    edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    regions = []
+    for start, end in zip(starts, ends):
+        if regions and start - regions[-1][1] < MIN_SILENCE_S / FRAME_S:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+
+    padding = int(PADDING_S * sample_rate)
+    padded = []
+    for start, end in regions:
+        if end - start < MIN_SPEECH_S / FRAME_S:
+            continue
+        start = max(0, start * frame_len - padding)
+        end = min(len(samples), end * frame_len + padding)
+        # A pause shorter than twice the padding would otherwise be in both regions
+        if padded and start <= padded[-1][1]:
+            padded[-1] = (padded[-1][0], end)
+        else:
+            padded.append((start, end))
+    return padded
+
+
+def split_long_region(samples, start, end, max_len, sample_rate=SAMPLE_RATE):
+    '''
+    Cuts a region longer than max_len at the quietest frame before the limit.
+    '''
+    frame_len = int(FRAME_S * sample_rate)
+    pieces = []
+    while end - start > max_len:
+        search_start = start + max_len - int(SPLIT_SEARCH_S * sample_rate)
+        energy = frame_energy_db(samples[search_start:start + max_len], frame_len)
+        cut = search_start + int(np.argmin(energy)) * frame_len if len(energy) else start + max_len
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+
+def split_on_silence(samples, sample_rate=SAMPLE_RATE, max_segment_s=MAX_SEGMENT_S):
+    '''
+    Drops the non-speech parts of a clip and packs the speech regions into segments
+    of at most max_segment_s seconds, cutting only at silences.
+    Returns the segments as arrays, a clip without speech has no segments.
+    '''
+    max_len = int(max_segment_s * sample_rate)
+    regions = []
+    for start, end in speech_regions(samples, sample_rate):
+        regions.extend(split_long_region(samples, start, end, max_len, sample_rate))
+
+    segments = []
+    current = []
+    current_len = 0
+    for start, end in regions:
+        if current and current_len + end - start > max_len:
+            segments.append(current)
+            current = []
+            current_len = 0
+        current.append((start, end))
+        current_len += end - start
+    if current:
+        segments.append(current)
+
+    # A single region is a view on the samples, only joined regions are copied
+    return [samples[segment[0][0]:segment[0][1]] if len(segment) == 1
+            else np.concatenate([samples[start:end] for start, end in segment])
+            for segment in segments]
@@ -0,0 +1,111 @@
+import os
+import struct
+from collections import namedtuple
+import numpy as np
+
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavHeader = namedtuple('WavHeader', [
+    'format_tag', 'channels', 'sample_rate', 'bits_per_sample',
+    'data_offset', 'data_size'])
+
+
+def read_wav_header(file_path):
+    '''
+    Reads the format of a .wav file from its RIFF header without decoding the audio.
+    Returns a WavHeader, for WAVE_FORMAT_EXTENSIBLE files format_tag is the
+    format of the sub type (PCM or float).
+    '''
+    with open(file_path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError(f"'{file_path}' is not a RIFF/WAVE file")
+
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError(f"'{file_path}' has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+
+            if chunk_id == b'fmt ':
+                data = f.read(chunk_size)
+                format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack(
+                    '<HHIIHH', data[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+                    # The first two bytes of the sub format GUID hold the real format
+                    format_tag = struct.unpack('<H', data[24:26])[0]
+                fmt = (format_tag, channels, sample_rate, bits_per_sample)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"'{file_path}' has no fmt chunk before the data")
+                return WavHeader(*fmt, data_offset=f.tell(), data_size=chunk_size)
+            else:
+                # Chunks are padded to an even number of bytes
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+
+def is_mono_pcm(header, sample_width=2):
+    '''
+    Checks if the header describes mono PCM audio with sample_width bytes per sample.
+    With sample_width=None any PCM width is accepted.
+    '''
+    if header.format_tag != WAVE_FORMAT_PCM or header.channels != 1:
+        return False
+    return sample_width is None or header.bits_per_sample == 8 * sample_width
+
+
+def read_wav_mmap(file_path):
+    '''
+    Memory-maps the samples of a mono 16-bit PCM .wav file.
+    Returns (samples, sample_rate) where samples is a read-only int16 array,
+    nothing is read from disk until the samples are used.
+    '''
+    header = read_wav_header(file_path)
+    if not is_mono_pcm(header, 2):
+        raise ValueError(f"'{file_path}' is not mono 16-bit PCM")
+
+    # Some writers leave the data size at its maximum, never map past the end of the file
+    data_size = min(header.data_size, os.path.getsize(file_path) - header.data_offset)
+    num_samples = data_size // 2
+    if num_samples == 0:
+        return np.zeros(0, dtype=np.int16), header.sample_rate
+
+    samples = np.memmap(file_path, dtype='<i2', mode='r',
+                        offset=header.data_offset, shape=(num_samples,))
+    return samples, header.sample_rate
+
+
+class BatchBuffer:
+    '''
+    Reusable float32 buffer for the clips of one batch.
+    fill() converts every clip into the same memory on each batch, int16 samples
+    are converted to float in a single pass, so the memory used depends on
+    the batch size and not on how many clips have been loaded.
+    '''
+
+    def __init__(self, num_samples=0):
+        self.buffer = np.empty(num_samples, dtype=np.float32)
+
+    def fill(self, clips):
+        '''
+        Copies the clips into the buffer and returns a float32 view per clip.
+        The views are overwritten by the next call.
+        '''
+        total = sum(len(clip) for clip in clips)
+        if total > len(self.buffer):
+            # Grow with some headroom so a slightly longer batch doesn't reallocate again
+            self.buffer = np.empty(max(total, int(len(self.buffer) * 1.5)),
+                                   dtype=np.float32)
+
+        views = []
+        offset = 0
+        for clip in clips:
+            view = self.buffer[offset:offset + len(clip)]
+            np.copyto(view, np.asarray(clip), casting='unsafe')
+            views.append(view)
+            offset += len(clip)
+        return views
@@ -1,40 +1,152 @@
+import math
 import os
-import re
 from scipy.io.wavfile import read as read_wav
 import torch
 import torchaudio
 import numpy as np
 import torch
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+from batching import MAX_BATCH_BYTES, MAX_BATCH_CLIPS, as_clip_stream
+from feature_cache import config_id, pad_frames, trim_frames
+from journal import open_journal
+from staged_pipeline import transcribe_stream
+from vad import split_on_silence
 
 
 pipe = None
+# CPU settings that change the transcripts, they are part of the journal config
+cpu_settings = {}
+# Extra generate() arguments for assisted decoding, empty without a draft model
+assistant_kwargs = {}
 
+MODEL_ID = "openai/whisper-large-v3"
+# MODEL_ID = "openai/whisper-small"
+# MODEL_ID = "openai/whisper-medium"
+OUTPUT_FILE = './whisper.txt'
+MAX_NEW_TOKENS = 128
+CHUNK_SAMPLES = 30 * 16000  # Clips up to 30 seconds are decoded in a single window
+GENERATE_KWARGS = {"language": "dutch"}
+# The draft gets the input features of the main model, so it needs the same 128 mel bins
+# as large-v3 (whisper-small and the other older models have 80)
+ASSISTANT_MODEL_ID = "distil-whisper/distil-large-v3"
+# Rough peak memory of one 30 second window going through large-v3 in float32,
+# used to keep a batch under max_batch_bytes
+BYTES_PER_WINDOW = 120 * 1024 ** 2
+# Every clip is encoded as at least one full 30 second window, so the default budget
+# is in windows: 24 clips up to 30 seconds per batch, about 2.8 GB by BYTES_PER_WINDOW
+BATCH_WINDOWS = 24
 
-def load_whisper_model():
-    global model
+
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    '''
+    Sets the intra-op (inside one matmul) and inter-op (between independent ops)
+    thread counts of torch. The inter-op count can only be set before torch
+    starts its first parallel work.
+    '''
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f'Could not set the inter-op threads to {num_interop_threads}: {e}')
+
+
+def optimize_for_cpu(model, quantize=False, compile=False):
+    '''
+    Dynamic int8 quantization of the linear layers: the weights are stored in int8
+    and the activations are quantized on the fly, about 4x less weight memory traffic.
+    compile=True compiles the encoder, which always sees the same 30 second input
+    shape, the decoder is left alone as its shape changes with every token.
+    '''
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+    if compile:
+        model.model.encoder = torch.compile(model.model.encoder)
+    return model
+
+
+def load_assistant_model(assistant_model_id, processor, device, torch_dtype):
+    '''
+    Loads a smaller Whisper that drafts tokens for the main model to verify (assisted
+    or speculative decoding). The main model checks all drafted tokens in one forward
+    pass and keeps them up to the first one it disagrees with, so the output is the
+    same as its own greedy decoding.
+    Returns the generate() arguments that turn it on.
+    '''
+    assistant_processor = AutoProcessor.from_pretrained(assistant_model_id)
+    # generate() feeds the features of the main model to the draft's encoder as well
+    if assistant_processor.feature_extractor.feature_size != processor.feature_extractor.feature_size:
+        raise ValueError(
+            f"{assistant_model_id} uses {assistant_processor.feature_extractor.feature_size} mel bins "
+            f"and the main model {processor.feature_extractor.feature_size}, "
+            f"use a draft with the same features such as {ASSISTANT_MODEL_ID}")
+
+    assistant = AutoModelForSpeechSeq2Seq.from_pretrained(
+        assistant_model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
+    )
+    assistant.to(device)
+
+    kwargs = {"assistant_model": assistant, "num_beams": 1, "do_sample": False}
+    if len(assistant_processor.tokenizer) != len(processor.tokenizer):
+        # large-v3 has one token more than the older models, the drafts are then
+        # translated through the text (universal assisted decoding)
+        kwargs["tokenizer"] = processor.tokenizer
+        kwargs["assistant_tokenizer"] = assistant_processor.tokenizer
+    return assistant, kwargs
+
+
+def generate_kwargs():
+    return {**GENERATE_KWARGS, **assistant_kwargs}
+
+
+def load_whisper_model(model_id=MODEL_ID, quantize=False, compile=False,
+                       num_threads=None, num_interop_threads=None, assistant_model_id=None):
+    '''
+    Loads the Whisper pipeline. On machines without GPU the model can be quantized
+    to int8 and its encoder compiled, and the torch thread counts can be tuned,
+    see benchmark_whisper.py for the effect on speed and WER.
+    With assistant_model_id (for example ASSISTANT_MODEL_ID) a smaller Whisper drafts
+    the tokens and the main model verifies them, the transcripts stay the same as
+    greedy decoding with the main model. Assisted decoding works one clip at a time.
+    '''
+    global model, cpu_settings, assistant_kwargs
     device = "cuda:0" if torch.cuda.is_available() else "cpu"
     torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
 
-    model_id = "openai/whisper-large-v3"
-    # model_id = "openai/whisper-small"
-    # model_id = "openai/whisper-medium"
+    set_cpu_threads(num_threads, num_interop_threads)
 
     model = AutoModelForSpeechSeq2Seq.from_pretrained(
         model_id, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True
     )
     model.to(device)
 
+    cpu_settings = {}
+    if device == "cpu" and (quantize or compile):
+        model = optimize_for_cpu(model, quantize, compile)
+        if quantize:
+            cpu_settings = {'quantize': 'int8'}
+    elif quantize or compile:
+        print('Quantization and compilation are CPU options, running the model on the GPU as is')
+
     processor = AutoProcessor.from_pretrained(model_id)
 
+    assistant_kwargs = {}
+    if assistant_model_id:
+        assistant, assistant_kwargs = load_assistant_model(
+            assistant_model_id, processor, device, torch_dtype)
+        if device == "cpu" and quantize:
+            assistant_kwargs["assistant_model"] = optimize_for_cpu(assistant, quantize)
+
     pipe = pipeline(
         "automatic-speech-recognition",
         model=model,
         tokenizer=processor.tokenizer,
         feature_extractor=processor.feature_extractor,
-        max_new_tokens=128,
+        max_new_tokens=MAX_NEW_TOKENS,
         chunk_length_s=30,
-        batch_size=20,
+        # The batch size is set per call, see process_audio_transcriptions_with_pipe
         torch_dtype=torch_dtype,
         device=device,
     )
@@ -42,39 +154,118 @@ def load_whisper_model():
     return pipe
 
 
-def process_audio_transcriptions_with_pipe(data, wav_files, pipe):
-    # Convert torch.Tensor objects to NumPy ndarrays
-    audio_numpy = [audio_tensor.numpy() for audio_tensor in data]
+def transcribe_cached(batch_data, pipe, feature_cache):
+    '''
+    Transcribes a batch with the log-mel features from the feature cache,
+    on a warm cache the feature extraction is skipped entirely.
+    Clips longer than 30 seconds still go through the pipe, which cuts them into chunks.
+    Returns the same list of {'text': ...} dicts as the pipe.
+    '''
+    result = [None] * len(batch_data)
+    short = [i for i, clip in enumerate(batch_data) if len(clip) <= CHUNK_SAMPLES]
+    long = [i for i, clip in enumerate(batch_data) if len(clip) > CHUNK_SAMPLES]
+
+    if short:
+        def compute(clips):
+            features = pipe.feature_extractor(
+                clips, sampling_rate=16000, return_tensors="np").input_features
+            # Most of a 30 second window is padding, only the frames up to it are stored
+            return [trim_frames(f) for f in features]
+
+        features = feature_cache.get_many(
+            [batch_data[i] for i in short], config_id(pipe.feature_extractor) + '-trimmed',
+            compute)
+        input_features = torch.from_numpy(np.stack([pad_frames(f) for f in features]))
+        input_features = input_features.to(pipe.device, dtype=pipe.model.dtype)
+
+        with torch.no_grad():
+            tokens = pipe.model.generate(
+                input_features, max_new_tokens=MAX_NEW_TOKENS, **generate_kwargs())
+        texts = pipe.tokenizer.batch_decode(tokens, skip_special_tokens=True)
+        for i, text in zip(short, texts):
+            result[i] = {'text': text}
+
+    if long:
+        outputs = pipe([batch_data[i] for i in long], batch_size=len(long),
+                       generate_kwargs=generate_kwargs())
+        for i, output in zip(long, outputs):
+            result[i] = output
+
+    return result
+
 
-    # Prepare audio data in batches
-    batch_size = 20
-    num_batches = (len(data) + batch_size - 1) // batch_size
+def window_samples(num_samples):
+    # Every started 30 second window is padded and encoded in full
+    return math.ceil(num_samples / CHUNK_SAMPLES) * CHUNK_SAMPLES
 
-    for i in range(num_batches):
-        start_idx = i * batch_size
-        end_idx = min((i + 1) * batch_size, len(data))
-        batch_data = audio_numpy[start_idx:end_idx]
-        batch_files = wav_files[start_idx:end_idx]
 
-        print('Working on batch:', batch_files)
+def window_bytes(num_samples):
+    return window_samples(num_samples) // CHUNK_SAMPLES * BYTES_PER_WINDOW
 
+
+def journal_config(pipe, vad=False):
+    # Everything that changes the transcripts, other settings start a new journal
+    return {'model': pipe.model.name_or_path, 'generate': GENERATE_KWARGS,
+            'max_new_tokens': MAX_NEW_TOKENS, 'vad': vad, **cpu_settings}
+
+
+def process_audio_transcriptions_with_pipe(data, wav_files, pipe, feature_cache=None,
+                                           max_batch_seconds=None,
+                                           max_batch_bytes=MAX_BATCH_BYTES,
+                                           vad=False):
+    '''
+    Transcribes the audio in batches and appends the results to whisper.txt.
+    data is a list of audio tensors matching wav_files, or a lazy stream of
+    (filename, samples) pairs from automate.process_audio_files(stream=True)
+    when wav_files is None.
+    With a feature_cache.FeatureCache the input features are read from disk
+    when the same clip was transcribed before.
+    Files already in the journal of this model and settings are skipped.
+    Batches hold up to max_batch_seconds of audio padded to 30 second windows
+    (None for BATCH_WINDOWS windows), and their estimated memory use stays under
+    max_batch_bytes (None for no limit).
+    With vad=True silences are trimmed and clips are cut into segments of at most
+    30 seconds at the pauses, the segment transcripts are joined per file.
+    When the pipe was loaded with a draft model, the clips are decoded one at a time
+    with assisted decoding.
+    The next batch is loaded and the previous one written while the model works,
+    see staged_pipeline.transcribe_stream.
+    '''
+    if max_batch_seconds is None:
+        max_batch_seconds = BATCH_WINDOWS * CHUNK_SAMPLES / 16000
+    journal = open_journal(OUTPUT_FILE, 'whisper', journal_config(pipe, vad))
+    clips = (clip for clip in as_clip_stream(data, wav_files)
+             if not journal.is_done(clip[0]))
+
+    def transcribe(batch_data):
         # Call the pipe function to generate text from audio
-        result = pipe(batch_data, generate_kwargs={"language": "dutch"})
-        # Regular expression pattern to extract text within single quotes
-        pattern = re.compile(r"'([^']*)'")
-
-        # Save the transcriptions to the output file after each batch
-        with open('./whisper.txt', 'a') as file:
-            for idx, translation in enumerate(result):
-                filename = batch_files[idx]
-                if isinstance(translation, dict):
-                    # If translation is a dictionary, extract the 'text' key
-                    if 'text' in translation:
-                        extracted_text = translation['text'].strip()
-                        file.write(f"{filename}|{extracted_text}\n")
-                    else:
-                        print(
-                            f"No 'text' key found in translation dictionary: {translation}")
+        if feature_cache is not None:
+            result = transcribe_cached(batch_data, pipe, feature_cache)
+        else:
+            result = pipe(batch_data, batch_size=len(batch_data),
+                          generate_kwargs=generate_kwargs())
+
+        transcripts = []
+        for translation in result:
+            text = None
+            if isinstance(translation, dict):
+                # If translation is a dictionary, extract the 'text' key
+                if 'text' in translation:
+                    text = translation['text'].strip()
                 else:
                     print(
-                        f"Translation is neither a string nor a dictionary: {translation}")
+                        f"No 'text' key found in translation dictionary: {translation}")
+            else:
+                print(
+                    f"Translation is neither a string nor a dictionary: {translation}")
+            transcripts.append(text)
+        return transcripts
+
+    # Batches of clips with a similar length, sized by the windows the encoder runs on
+    transcribe_stream(clips, transcribe, journal, split=split_on_silence if vad else None,
+                      max_seconds=max_batch_seconds,
+                      max_clips=1 if assistant_kwargs else MAX_BATCH_CLIPS,
+                      max_bytes=max_batch_bytes, clip_bytes=window_bytes,
+                      clip_length=window_samples)
+    if feature_cache is not None:
+        feature_cache.report()